@@ -0,0 +1,371 @@
+# Benchmarks for the functions in utils.py and plots.py, run on synthetic scRNA-seq/spatial data
+#
+# Usage (from the repository root):
+#   python -m scripts.py.benchmark --scales 10000 100000 --formats sparse dense --out bench_history.json
+#
+# Every run appends one record per (function, scale, format) to a JSON history file, with the git commit,
+# wall time and peak memory, so that regressions can be spotted across commits. Wall time and memory come from
+# separate calls (tracemalloc slows the code it traces), and peak RSS is reset before each call where the kernel
+# allows it (Linux); memory used by worker processes is not included.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timezone
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import scipy.io
+import pandas as pd
+import scipy.sparse as sp
+import anndata as ad
+
+try:
+    from . import utils, plots, interactions
+    from .profiling import _read_rss, _reset_peak_rss
+except ImportError:
+    import utils, plots, interactions
+    from profiling import _read_rss, _reset_peak_rss
+
+
+# Synthetic AnnData with counts, fake spatial coordinates (several round "tissues"), clusters and a PCA-like embedding
+def make_synthetic_adata(
+    n_cells: int,
+    n_genes: int = 2000,
+    density: float = 0.05,
+    sparse: bool = True,
+    n_tissues: int = 4,
+    n_clusters: int = 12,
+    seed: int = 0
+) -> ad.AnnData:
+    rng = np.random.default_rng(seed)
+
+    nnz = int(n_cells * n_genes * density)
+    X = sp.csr_matrix(
+        (
+            rng.poisson(2, nnz).astype(np.float32) + 1,
+            (rng.integers(0, n_cells, nnz), rng.integers(0, n_genes, nnz))
+        ),
+        shape=(n_cells, n_genes)
+    )
+    X.sum_duplicates()
+    if not sparse:
+        X = X.toarray()
+
+    # Tissues: discs on a grid, with spot density independent of n_cells
+    tissue = rng.integers(0, n_tissues, n_cells)
+    radius = np.sqrt(n_cells / n_tissues) * 2
+    centers = np.column_stack([np.arange(n_tissues) * radius * 3, np.zeros(n_tissues)])
+    theta = rng.uniform(0, 2 * np.pi, n_cells)
+    r = radius * np.sqrt(rng.uniform(0, 1, n_cells))
+    spatial = centers[tissue] + np.column_stack([r * np.cos(theta), r * np.sin(theta)])
+
+    clusters = rng.integers(0, n_clusters, n_cells)
+    adata = ad.AnnData(
+        X,
+        obs=pd.DataFrame(
+            {
+                "sample": pd.Categorical(np.char.add("S", (tissue % 2).astype(str))),
+                "cluster": pd.Categorical(clusters.astype(str)),
+                "score": rng.normal(size=n_cells)
+            },
+            index=[f"cell{i}" for i in range(n_cells)]
+        ),
+        var=pd.DataFrame(index=[f"ENSG{i:011d}" for i in range(n_genes)])
+    )
+    adata.obsm["spatial"] = spatial
+    adata.obsm["X_umap"] = rng.normal(size=(n_cells, 2)) + clusters[:, None]
+    adata.obsm["pca"] = rng.normal(size=(n_cells, 50)) * np.linspace(5, 0.1, 50)[rng.permutation(50)]
+    adata.uns["cluster_colors"] = [matplotlib.colors.to_hex(plt.get_cmap("tab20")(k)) for k in range(n_clusters)]
+    return adata
+
+
+# Fake GTF (GENEID -> GeneSymbol) and biomart (GeneSymbol -> Biotype) tables for the synthetic genes
+def make_synthetic_annotation(
+    adata: ad.AnnData,
+    n_biotypes: int = 40,
+    seed: int = 0
+):
+    rng = np.random.default_rng(seed)
+    gene_ids = adata.var_names.values
+    symbols = np.char.add("GENE", np.arange(len(gene_ids)).astype(str))
+    gtf_info = pd.DataFrame({"GENEID": gene_ids, "GeneSymbol": symbols})
+    biomart = pd.DataFrame({
+        "GeneSymbol": symbols,
+        "Biotype": np.char.add("biotype_", rng.integers(0, n_biotypes, len(symbols)).astype(str))
+    })
+    return gtf_info, biomart
+
+
+def _roi_square(x0, y0, w):
+    return {"x": [x0, x0 + w, x0 + w, x0], "y": [y0, y0, y0 + w, y0 + w]}
+
+
+# Light copy of the spatial/embedding parts of the synthetic data, for functions that modify their input
+def _light_copy(adata, obsm_keys):
+    return ad.AnnData(obs=adata.obs[[]].copy(), obsm={k: adata.obsm[k].copy() for k in obsm_keys})
+
+
+# Files derived from the synthetic data, written on first use (untimed) and reused for the rest of the scale
+def _ctx_file(ctx, name):
+    if name in ctx:
+        return ctx[name]
+    adata, tmp_dir = ctx["adata_symbols"], ctx["tmp_dir"]
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    if name == "mtx_dir":
+        # STARsolo-style sample directory (genes x barcodes, uncompressed)
+        out = os.path.join(tmp_dir, "sample", "Solo.out", "GeneFull", "filtered")
+        os.makedirs(out, exist_ok=True)
+        scipy.io.mmwrite(os.path.join(out, "matrix.mtx"), sp.csr_matrix(adata.X).T.tocoo())
+        pd.DataFrame({
+            "id": ctx["adata"].var_names, "symbol": adata.var_names, "type": "Gene Expression"
+        }).to_csv(os.path.join(out, "features.tsv"), sep="\t", header=False, index=False)
+        pd.Series(adata.obs_names).to_csv(os.path.join(out, "barcodes.tsv"), header=False, index=False)
+    elif name == "npy_dir":
+        out = os.path.join(tmp_dir, "layer_npy")
+        utils.save_mtx_components(sp.csr_matrix(adata.X), out)
+    elif name == "h5ad":
+        out = os.path.join(tmp_dir, "adata.h5ad")
+        ad.AnnData(adata.X, obs=adata.obs[["cluster"]], var=adata.var[[]]).write_h5ad(out)
+
+    ctx[name] = out
+    return out
+
+
+def _ctx_meta(ctx):
+    # Two samples pointing at the same synthetic sample directory, with permissive QC thresholds
+    _ctx_file(ctx, "mtx_dir")
+    return pd.DataFrame({
+        "sample": ["S0", "S1"],
+        "data.dir": [os.path.join(ctx["tmp_dir"], "sample")] * 2,
+        "soupx": ["FALSE"] * 2,
+        "min_genes": [5] * 2, "min_counts": [5] * 2, "min_cells": [1] * 2, "max_pct_mito": [100] * 2,
+        "doublet_cutoff": [0.3] * 2
+    })
+
+
+def _ranked(ctx):
+    a = ad.AnnData(ctx["adata"].X, obs=ctx["adata"].obs[["cluster"]], var=ctx["adata"].var)
+    utils.rank_genes_wilcoxon(a, "cluster", n_genes=200, n_jobs=1, verbose=False)
+    return a
+
+
+# name -> setup function of the benchmark context; the setup runs untimed and returns the (timed) call
+BENCHMARKS = {
+    "segment_tissues": lambda ctx: (lambda a=_light_copy(ctx["adata"], ["spatial"]): utils.segment_tissues(
+        a, threshold=ctx["spacing"] * 3, verbose=False)),
+    "spatial_singlet_filter": lambda ctx: (lambda a=_light_copy(ctx["adata"], ["spatial"]): utils.spatial_singlet_filter(
+        a, D=ctx["spacing"] * 3, K=2, verbose=False)),
+    "add_biotypes_pct": lambda ctx: (lambda a=ctx["adata_symbols"].copy(): utils.add_biotypes_pct(
+        a, ctx["biomart"], verbose=False)),
+    "build_feature_map": lambda ctx: (lambda: utils.build_feature_map(ctx["gtf_info"], verbose=False)),
+    "convert_feature_names": lambda ctx: (lambda: utils.convert_feature_names(
+        ctx["adata"], ctx["gtf_info"], inplace=False, verbose=False)),
+    "top_n_genes": lambda ctx: (lambda: utils.top_n_genes(ctx["adata"], 50)),
+    "top_n_genes_groupby": lambda ctx: (lambda: utils.top_n_genes(ctx["adata"], 50, groupby="cluster")),
+    "pseudobulk": lambda ctx: (lambda: utils.pseudobulk(ctx["adata"], ["sample", "cluster"], verbose=False)),
+    "rank_genes_wilcoxon": lambda ctx: (lambda a=ad.AnnData(ctx["adata"].X, obs=ctx["adata"].obs[["cluster"]], var=ctx["adata"].var):
+        utils.rank_genes_wilcoxon(a, "cluster", verbose=False)),
+    "variance_profile": lambda ctx: (lambda: utils.variance_profile(ctx["adata"], ["pca", "X_umap"])),
+    "npcs": lambda ctx: (lambda a=_light_copy(ctx["adata"], ["pca"]): utils.npcs(a, reduction="pca")),
+    "reorder_reduction": lambda ctx: (lambda a=_light_copy(ctx["adata"], ["pca"]): utils.reorder_reduction(a, reduction="pca")),
+    "regress_out": lambda ctx: (lambda a=ctx["adata"].copy(): utils.regress_out(a, ["score"])),
+    "label_roi_polygon": lambda ctx: (lambda a=_light_copy(ctx["adata"], ["spatial"]): utils.label_roi_polygon(
+        a, ctx["rois"], metadata_col_name="bench_roi")),
+    "read_csv_to_dict": lambda ctx: (lambda: utils.read_csv_to_dict(
+        ctx["gene_list_csv"], ctx["adata_symbols"].var_names, use_cache=False)),
+    "score_gene_panels": lambda ctx: (lambda a=ctx["adata_symbols"].copy(): utils.score_gene_panels(
+        a, ctx["gene_list_csv"], obsm_key="bench_panels", verbose=False)),
+    "lr_scores": lambda ctx: (lambda: interactions.lr_scores(
+        ctx["adata_symbols"], "cluster", ctx["lr_table"], min_frac=0.01, n_perms=100, verbose=False)),
+    "chunked_reduce": lambda ctx: (lambda: utils.chunked_reduce(ctx["adata"].X, "sum", axis=0)),
+    "chunked_reduce_backed": lambda ctx: (lambda a=ad.read_h5ad(_ctx_file(ctx, "h5ad"), backed="r"):
+        utils.chunked_reduce(a.X, "sum", axis=0)),
+    "export_dgea_to_csv": lambda ctx: (lambda a=_ranked(ctx): utils.export_dgea_to_csv(
+        a, "rank_genes_groups", 100, os.path.join(ctx["tmp_dir"], "dgea.csv"))),
+    "add_mtx_as_layer": lambda ctx: (lambda a=ad.AnnData(obs=ctx["adata"].obs[[]], var=ctx["adata"].var[[]]),
+        d=_ctx_file(ctx, "npy_dir"): utils.add_mtx_as_layer(
+        a, d, ctx["adata"].obs_names.values, ctx["adata"].var_names.values, "counts")),
+    "barcode_rank_qc": lambda ctx: (lambda d=_ctx_file(ctx, "mtx_dir"): utils.barcode_rank_qc(d, verbose=False)),
+    "barcode_rank_qc_samples": lambda ctx: (lambda m=_ctx_meta(ctx): utils.barcode_rank_qc_samples(
+        m, raw_subdir="Solo.out/GeneFull/filtered", verbose=False)),
+    "concatenate_to_h5ad": lambda ctx: (lambda p=_ctx_file(ctx, "h5ad"): utils.concatenate_to_h5ad(
+        [p, p], os.path.join(ctx["tmp_dir"], "concat.h5ad"), verbose=False)),
+    "load_samples": lambda ctx: (lambda m=_ctx_meta(ctx): utils.load_samples(m, verbose=False)),
+    "qc_samples": lambda ctx: (lambda l=[ctx["adata_symbols"].copy() for _ in range(2)], m=_ctx_meta(ctx):
+        utils.qc_samples(l, m, run_scrublet=False, verbose=False)),
+    "knee_plot": lambda ctx: (lambda: plots.knee_plot(ctx["adata"])),
+    # scanpy (scatter) backend as the baseline for the raster backend
+    "facet_embedding_scanpy": lambda ctx: (lambda: plots.facet_embedding(
+        ctx["adata"], "cluster", "umap", backend="scanpy", show=False)),
+    "facet_embedding_raster": lambda ctx: (lambda: plots.facet_embedding(
+        ctx["adata"], "cluster", "umap", backend="raster", show=False)),
+    "plot_grid_of_embeddings_scanpy": lambda ctx: (lambda: plots.plot_grid_of_embeddings(
+        {"a": ctx["adata_symbols"], "b": ctx["adata_symbols"]}, ["GENE1", "GENE2", "score"],
+        basis="umap", backend="scanpy", same_scale=True)),
+    "plot_grid_of_embeddings_raster": lambda ctx: (lambda: plots.plot_grid_of_embeddings(
+        {"a": ctx["adata_symbols"], "b": ctx["adata_symbols"]}, ["GENE1", "GENE2", "score"],
+        basis="umap", backend="raster", same_scale=True)),
+}
+
+
+# Time one call, then measure the peak memory of a second, identical call
+def run_one(setup, ctx) -> dict:
+    fn = setup(ctx)
+    t0 = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - t0
+    plt.close("all")
+
+    fn = setup(ctx)
+    rss_start, _ = _read_rss()
+    per_call = _reset_peak_rss()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_rss = _read_rss()[1]
+    plt.close("all")
+    return {
+        "wall_time_s": wall,
+        "peak_alloc_mb": peak / 1024**2,
+        "peak_rss_mb": peak_rss,
+        "rss_delta_mb": peak_rss - rss_start,
+        "rss_scope": "call" if per_call else "process"
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(
+    scales=None,
+    formats=None,
+    n_genes: int = 2000,
+    functions=None,
+    repeat: int = 1,
+    out: str = "bench_history.json",
+    verbose: bool = True
+) -> pd.DataFrame:
+    """
+    Run the benchmarks at each scale/format, append the results to the JSON history file `out`, and return them.
+
+    Args:
+        scales (list): Numbers of cells. Default is [10000, 100000].
+        formats (list): 'sparse' and/or 'dense' expression matrices. Default is ['sparse'].
+        n_genes (int): Number of genes.
+        functions (list): Names from BENCHMARKS to run. Default is all of them.
+        repeat (int): Number of timed calls per benchmark (the fastest is kept).
+        out (str): JSON history file (a list of records). Created if missing.
+        verbose (bool): Print each result.
+
+    Returns:
+        pd.DataFrame of this run's records.
+    """
+    import tempfile
+
+    scales = [10000, 100000] if scales is None else scales
+    formats = ["sparse"] if formats is None else formats
+    functions = list(BENCHMARKS) if functions is None else functions
+    run_info = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "n_cpus": os.cpu_count()
+    }
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_cells in scales:
+            for fmt in formats:
+                adata = make_synthetic_adata(n_cells, n_genes=n_genes, sparse=(fmt == "sparse"))
+                gtf_info, biomart = make_synthetic_annotation(adata)
+                adata_symbols = utils.convert_feature_names(adata, gtf_info, inplace=False, verbose=False)
+
+                gene_list_csv = os.path.join(tmp_dir, "panels.csv")
+                pd.DataFrame({
+                    f"panel{k}": adata_symbols.var_names[k * 20:(k + 1) * 20] for k in range(15)
+                }).to_csv(gene_list_csv, index=False)
+
+                lr_table = os.path.join(tmp_dir, "lr_pairs.csv")
+                rng = np.random.default_rng(0)
+                pd.DataFrame({
+                    "ligand": adata_symbols.var_names[rng.integers(0, n_genes, 500)],
+                    "receptor": adata_symbols.var_names[rng.integers(0, n_genes, 500)]
+                }).to_csv(lr_table, index=False)
+
+                spacing = np.sqrt(np.pi * (np.sqrt(n_cells / 4) * 2) ** 2 / (n_cells / 4))
+                span = adata.obsm["spatial"].max(axis=0) - adata.obsm["spatial"].min(axis=0)
+                lo = adata.obsm["spatial"].min(axis=0)
+                ctx = {
+                    "tmp_dir": os.path.join(tmp_dir, f"{n_cells}_{fmt}"),
+                    "adata": adata,
+                    "adata_symbols": adata_symbols,
+                    "gtf_info": gtf_info,
+                    "biomart": biomart,
+                    "gene_list_csv": gene_list_csv,
+                    "lr_table": lr_table,
+                    "spacing": spacing,
+                    "rois": {
+                        f"roi{k}": _roi_square(lo[0] + span[0] * k / 50, lo[1] + span[1] * 0.3, span[0] / 60)
+                        for k in range(50)
+                    }
+                }
+
+                for name in functions:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore")
+                        results = [run_one(BENCHMARKS[name], ctx) for _ in range(repeat)]
+                    best = min(results, key=lambda r: r["wall_time_s"])
+                    record = {
+                        **run_info, "function": name, "n_cells": n_cells, "n_genes": n_genes,
+                        "format": fmt, "repeat": repeat, **best
+                    }
+                    records.append(record)
+                    if verbose:
+                        print(f"{name:32s} {n_cells:>9d} {fmt:6s} {best['wall_time_s']:9.3f} s {best['peak_alloc_mb']:10.1f} MB {best['rss_delta_mb']:10.1f} MB RSS")
+
+    history = []
+    if os.path.isfile(out):
+        with open(out) as f:
+            history = json.load(f)
+    history.extend(records)
+    with open(out, "w") as f:
+        json.dump(history, f, indent=1)
+
+    return pd.DataFrame(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark scripts/py/utils.py and plots.py on synthetic data")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000], help="numbers of cells (e.g. 10000 100000 1000000)")
+    parser.add_argument("--formats", nargs="+", default=["sparse"], choices=["sparse", "dense"])
+    parser.add_argument("--n-genes", type=int, default=2000)
+    parser.add_argument("--functions", nargs="+", default=None, choices=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--out", default="bench_history.json", help="JSON history file to append to")
+    args = parser.parse_args()
+
+    run_benchmarks(
+        scales=args.scales,
+        formats=args.formats,
+        n_genes=args.n_genes,
+        functions=args.functions,
+        repeat=args.repeat,
+        out=args.out
+    )
@@ -0,0 +1,286 @@
+# Ligand-receptor interaction scoring for use with scanpy (a Python alternative to the CellChat workflow)
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse import issparse
+try:
+    from .utils import _iter_row_blocks
+    from .profiling import profiled, worker_call, collect_worker_records
+except ImportError:
+    from utils import _iter_row_blocks
+    from profiling import profiled, worker_call, collect_worker_records
+
+
+# Column names used for ligands/receptors in common ligand-receptor tables (OmniPath, CellChatDB, Cellinker, CellPhoneDB)
+LIGAND_COLUMNS = ["ligand", "source_genesymbol", "Ligand_symbol", "ligand_symbol", "partner_a", "source"]
+RECEPTOR_COLUMNS = ["receptor", "target_genesymbol", "Receptor_symbol", "receptor_symbol", "partner_b", "target"]
+
+
+# Load a local ligand-receptor table
+@profiled
+def read_lr_table(
+    filename,
+    ligand_col=None,
+    receptor_col=None,
+    ligand_subunits_col=None,
+    receptor_subunits_col=None,
+    subunit_sep=",",
+    extra_cols=None
+) -> pd.DataFrame:
+    """
+    Read a ligand-receptor table (.csv/.tsv, e.g. an OmniPath or Cellinker download) into a standard layout.
+
+    Without subunit columns, each name is one gene (gene symbols may contain "_"), except OmniPath complexes
+    ("COMPLEX:ITGA1_ITGB1"), which are split on "_" as in OmniPath's format.
+
+    Args:
+        filename (str): Path to the table. Tab-separated if it ends in .tsv/.txt, comma-separated otherwise.
+        ligand_col (str, optional): Column with ligand gene symbols. Default is the first of LIGAND_COLUMNS found.
+        receptor_col (str, optional): Column with receptor gene symbols. Default is the first of RECEPTOR_COLUMNS found.
+        ligand_subunits_col (str, optional): Column listing the subunit genes of each ligand, separated by `subunit_sep` (e.g. "ITGA1,ITGB1"). Default is None.
+        receptor_subunits_col (str, optional): Same, for receptors. Default is None.
+        subunit_sep (str, optional): Separator in the subunit columns. Default is ",".
+        extra_cols (list, optional): Columns to keep if present (e.g. the pathway). If None, ["pathway_name", "annotation", "category"] is used. Default is None.
+
+    Returns:
+        pd.DataFrame with columns 'ligand', 'receptor', 'pair' ("ligand-receptor"), 'ligand_subunits' and
+        'receptor_subunits' (lists of genes), plus any `extra_cols` found. Duplicate pairs are dropped.
+    """
+    if extra_cols is None:
+        extra_cols = ["pathway_name", "annotation", "category"]
+
+    sep = "\t" if str(filename).endswith((".tsv", ".txt", ".tsv.gz", ".txt.gz")) else ","
+    df = pd.read_csv(filename, sep=sep, dtype=str, keep_default_na=False)
+
+    def _find(col, candidates, what):
+        if col is not None:
+            return col
+        for c in candidates:
+            if c in df.columns:
+                return c
+        raise ValueError(f"No {what} column found in {filename}; set it with `{what}_col`")
+
+    ligand_col = _find(ligand_col, LIGAND_COLUMNS, "ligand")
+    receptor_col = _find(receptor_col, RECEPTOR_COLUMNS, "receptor")
+
+    def _subunits(name_col, subunits_col):
+        if subunits_col is not None:
+            return df[subunits_col].map(lambda x: [g.strip() for g in x.split(subunit_sep) if g.strip() != ""])
+        names = df[name_col].str.strip()
+        return pd.Series(
+            [n[len("COMPLEX:"):].split("_") if n.startswith("COMPLEX:") else [n] for n in names],
+            index=df.index
+        )
+
+    lr = pd.DataFrame({
+        "ligand": df[ligand_col].str.replace("COMPLEX:", "", regex=False).str.strip(),
+        "receptor": df[receptor_col].str.replace("COMPLEX:", "", regex=False).str.strip(),
+        "ligand_subunits": _subunits(ligand_col, ligand_subunits_col),
+        "receptor_subunits": _subunits(receptor_col, receptor_subunits_col)
+    })
+    for c in extra_cols:
+        if c in df.columns:
+            lr[c] = df[c].values
+    lr = lr.loc[(lr["ligand"] != "") & (lr["receptor"] != "")]
+    lr = lr.loc[(lr["ligand_subunits"].map(len) > 0) & (lr["receptor_subunits"].map(len) > 0)]
+    lr = lr.drop_duplicates(["ligand", "receptor"]).reset_index(drop=True)
+
+    lr.insert(2, "pair", lr["ligand"] + "-" + lr["receptor"])
+    return lr
+
+
+# Per-group mean expression (and fraction expressing) for one or more label vectors, via one sparse indicator product
+def _group_means(Xg, codes, n_groups, fraction=False):
+    """
+    `codes` is (n_labelings x cells); returns means of shape (n_labelings x groups x genes), and fractions if requested.
+    """
+    codes = np.atleast_2d(codes)
+    n_lab, n_cells = codes.shape
+    indicator = sp.csr_matrix(
+        (np.ones(codes.size), ((codes + np.arange(n_lab)[:, None] * n_groups).ravel(), np.tile(np.arange(n_cells), n_lab))),
+        shape=(n_lab * n_groups, n_cells)
+    )
+    counts = np.bincount(codes[0], minlength=n_groups)[None, :, None]
+
+    _dense = lambda m: m.toarray() if issparse(m) else np.asarray(m)
+    means = _dense(indicator @ Xg).reshape(n_lab, n_groups, -1) / np.maximum(counts, 1)
+    if not fraction:
+        return means
+    frac = _dense(indicator @ (Xg != 0).astype(np.float64)).reshape(n_lab, n_groups, -1) / np.maximum(counts, 1)
+    return means, frac
+
+
+# Ligand/receptor expression per group (minimum over the subunits of complexes) and the sender x receiver x pair scores
+def _lr_scores(means, lig_idx, rec_idx, method):
+    # padded subunit slots point at an extra +inf column, so they never win the minimum
+    means = np.concatenate([means, np.full(means.shape[:-1] + (1,), np.inf)], axis=-1)
+    lig = means[..., lig_idx].min(axis=-1) # (..., groups, pairs)
+    rec = means[..., rec_idx].min(axis=-1)
+    if method == "product":
+        return lig[..., :, None, :] * rec[..., None, :, :]
+    return (lig[..., :, None, :] + rec[..., None, :, :]) / 2
+
+
+# Data shared by all permutation batches; set once per worker process by the pool initializer
+_PERM_STATE = None
+
+
+def _init_permutation_worker(*state):
+    global _PERM_STATE
+    _PERM_STATE = state
+
+
+# One batch of label permutations; module-level so it can be sent to worker processes
+def _permutation_batch(n_perm, seed, state=None):
+    """
+    Number of permutations (out of `n_perm`) whose score is >= the observed one, per sender x receiver x pair.
+    Group means for the whole batch come from one stacked product; scores are compared one permutation at a time,
+    so only one (groups x groups x pairs) null array exists at once.
+    """
+    Xg, codes, n_groups, lig_idx, rec_idx, observed, method = _PERM_STATE if state is None else state
+    rng = np.random.default_rng(seed)
+    perms = np.stack([rng.permutation(codes) for _ in range(n_perm)])
+    means = _group_means(Xg, perms, n_groups)
+
+    counts = np.zeros(observed.shape, dtype=np.int64)
+    for b in range(n_perm):
+        counts += _lr_scores(means[b], lig_idx, rec_idx, method) >= observed
+    return counts
+
+
+# Score all sender x receiver x ligand-receptor pair combinations, with a permutation test
+@profiled
+def lr_scores(
+    adata,
+    groupby: str,
+    lr_table,
+    layer=None,
+    method: str = "mean",
+    min_frac: float = 0.1,
+    n_perms: int = 1000,
+    batch_size: int = 50,
+    seed: int = 0,
+    n_jobs=None,
+    chunk_size: int = 10000,
+    key_added=None,
+    verbose: bool = True
+) -> pd.DataFrame:
+    """
+    Ligand-receptor interaction scores between all pairs of groups (CellPhoneDB/squidpy-style permutation test).
+
+    Mean expression of the ligand/receptor genes is computed once per group with a sparse group-indicator product
+    (complexes take the minimum over their subunits). All sender x receiver x pair scores are then one broadcast
+    operation. For the null, group labels are permuted `batch_size` times per task (one stacked indicator product
+    per batch), with batches spread over a process pool. Each batch has its own seed derived from `seed`, so results
+    do not depend on `n_jobs`.
+
+    Args:
+        adata (AnnData): The AnnData object with log-normalized expression and gene symbols as var_names (may be backed).
+        groupby (str): Categorical obs column with the groups (e.g. cell types). Cells without a group are left out.
+        lr_table (str or pd.DataFrame): Path to a ligand-receptor table, or the output of read_lr_table.
+        layer (str, optional): Layer to use instead of adata.X. Default is None.
+        method (str, optional): "mean" ((ligand + receptor) / 2) or "product" (ligand * receptor). Default is "mean".
+        min_frac (float, optional): Minimum fraction of cells in the sender (receiver) expressing every ligand (receptor) subunit; other combinations get a NaN p-value. Default is 0.1.
+        n_perms (int, optional): Number of label permutations. 0 skips the test. Default is 1000.
+        batch_size (int, optional): Number of permutations per task. Default is 50.
+        seed (int, optional): Random seed. Default is 0.
+        n_jobs (int, optional): Number of worker processes. 1 runs in this process. Default is None (one per core).
+        chunk_size (int, optional): Number of cells read at a time for backed/dask matrices. Default is 10000.
+        key_added (str, optional): If given, also store the result in adata.uns[key_added]. Default is None.
+        verbose (bool, optional): Print progress. Default is True.
+
+    Returns:
+        pd.DataFrame with one row per (sender, receiver, pair): 'sender', 'receiver', 'ligand', 'receptor', 'pair',
+        'score', 'pvalue' (and any extra columns of the ligand-receptor table).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if method not in ["mean", "product"]:
+        raise ValueError(f"method must be 'mean' or 'product', not '{method}'")
+
+    lr = read_lr_table(lr_table) if isinstance(lr_table, str) else lr_table.reset_index(drop=True)
+
+    # Keep the pairs with all subunits measured
+    var_pos = pd.Series(np.arange(adata.n_vars), index=adata.var_names)
+    var_pos = var_pos[~var_pos.index.duplicated()]
+    found = lambda genes: all(g in var_pos.index for g in genes)
+    keep = lr["ligand_subunits"].map(found) & lr["receptor_subunits"].map(found)
+    lr = lr.loc[keep].reset_index(drop=True)
+    if len(lr) == 0:
+        raise ValueError("None of the ligand-receptor pairs are fully measured in adata.var_names")
+
+    # Expression of the ligand/receptor genes only (cells with a group x genes)
+    genes = pd.unique(np.concatenate(lr["ligand_subunits"].tolist() + lr["receptor_subunits"].tolist()))
+    gene_pos = pd.Series(np.arange(len(genes)), index=genes)
+    X = adata.X if layer is None else adata.layers[layer]
+    cols = var_pos[genes].values
+    Xg = sp.vstack([
+        sp.csr_matrix(block[:, cols] if issparse(block) else np.asarray(block)[:, cols])
+        for _, _, block in _iter_row_blocks(X, chunk_size)
+    ]).tocsr()
+
+    groups = adata.obs[groupby].astype("category")
+    codes = groups.cat.codes.values
+    Xg = Xg[np.flatnonzero(codes >= 0)]
+    codes = codes[codes >= 0].astype(np.int64)
+    categories = groups.cat.categories.astype(str)
+    n_groups = len(categories)
+
+    # Subunit positions, padded with an index past the last gene
+    def _pad(subunits):
+        width = max(len(s) for s in subunits)
+        return np.array([[gene_pos[g] for g in s] + [len(genes)] * (width - len(s)) for s in subunits])
+    lig_idx = _pad(lr["ligand_subunits"])
+    rec_idx = _pad(lr["receptor_subunits"])
+
+    if verbose:
+        print(f"Scoring {len(lr)} ligand-receptor pairs between {n_groups} groups...")
+    means, frac = _group_means(Xg, codes, n_groups, fraction=True)
+    observed = _lr_scores(means, lig_idx, rec_idx, method)[0] # (senders, receivers, pairs)
+
+    # Expressed: every subunit above min_frac in the sender (ligand) / receiver (receptor)
+    frac = np.concatenate([frac[0], np.ones((n_groups, 1))], axis=1)
+    lig_ok = frac[:, lig_idx].min(axis=-1) >= min_frac
+    rec_ok = frac[:, rec_idx].min(axis=-1) >= min_frac
+    expressed = lig_ok[:, None, :] & rec_ok[None, :, :]
+
+    pvalues = np.full(observed.shape, np.nan)
+    if n_perms > 0:
+        sizes = [batch_size] * (n_perms // batch_size) + ([n_perms % batch_size] if n_perms % batch_size else [])
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        state = (Xg, codes, n_groups, lig_idx, rec_idx, observed, method)
+        if verbose:
+            print(f"Running {n_perms} permutations in {len(sizes)} batches...")
+
+        if n_jobs is None:
+            n_jobs = min(len(sizes), os.cpu_count() or 1)
+        if n_jobs == 1:
+            counts = sum(_permutation_batch(size, s, state) for size, s in zip(sizes, seeds))
+        else:
+            # the expression matrix etc. are sent once per worker, not once per batch
+            with ProcessPoolExecutor(
+                max_workers=max(1, n_jobs), initializer=_init_permutation_worker, initargs=state
+            ) as pool:
+                counts = sum(
+                    collect_worker_records(r)
+                    for r in pool.map(worker_call, [_permutation_batch] * len(sizes), sizes, seeds)
+                )
+        pvalues = np.where(expressed, (counts + 1) / (n_perms + 1), np.nan)
+
+    # Long table: sender x receiver x pair
+    sender, receiver, pair = np.meshgrid(np.arange(n_groups), np.arange(n_groups), np.arange(len(lr)), indexing="ij")
+    out = pd.DataFrame({
+        "sender": pd.Categorical.from_codes(sender.ravel(), categories),
+        "receiver": pd.Categorical.from_codes(receiver.ravel(), categories),
+        "score": observed.ravel(),
+        "pvalue": pvalues.ravel()
+    })
+    meta_cols = [c for c in lr.columns if c not in ["ligand_subunits", "receptor_subunits"]]
+    out = pd.concat([out, lr[meta_cols].iloc[pair.ravel()].reset_index(drop=True)], axis=1)
+    out = out[["sender", "receiver", "ligand", "receptor", "pair", "score", "pvalue"] + [c for c in meta_cols if c not in ["ligand", "receptor", "pair"]]]
+
+    if key_added is not None:
+        adata.uns[key_added] = out
+
+    return out
@@ -3,34 +3,66 @@ import numpy as np
 import scanpy as sc
 import pandas as pd
 import matplotlib.pyplot as plt
-from matplotlib import cm
 from anndata import AnnData
+try:
+    from .utils import barcode_rank_curve, barcode_rank_qc, chunked_reduce
+    from .profiling import profiled
+except ImportError:
+    from utils import barcode_rank_curve, barcode_rank_qc, chunked_reduce
+    from profiling import profiled
 # import anndata as ad
 
 # Knee plot to quality check UMI counts for single-cell data
+@profiled
 def knee_plot(
     ADATA,
     x_lim=[0, 20000],
     line_width=2,
     line_color="b",
     title="Knee plot",
+    expected_num_cells=None,
+    n_points=2000,
     verbose=False
 ):
+    """
+    Barcode rank ("knee") plot of UMI counts.
+
+    Parameters:
+        ADATA: An AnnData object (in memory or backed), the output of `barcode_rank_qc` (streamed from a raw matrix), or a path to a raw matrix.
+        x_lim (list): x-axis (UMI counts) limits.
+        line_width, line_color: Line style of the rank curve.
+        title (str): Plot title.
+        expected_num_cells (int): If given, mark this rank and its UMI count.
+        n_points (int): Maximum number of log-spaced ranks drawn.
+        verbose (bool): If True, print the knee/inflection estimates.
+    """
     import matplotlib.pyplot as plt
-    expected_num_cells = 10000
 
-    knee = np.sort((np.array(ADATA.X.sum(axis=1))).flatten())[::-1]
+    if isinstance(ADATA, dict):
+        qc = ADATA
+    elif isinstance(ADATA, str):
+        qc = barcode_rank_qc(ADATA, n_points=n_points, verbose=False)
+    else:
+        qc = barcode_rank_curve(chunked_reduce(ADATA.X, "sum", axis=1), n_points=n_points)
+
+    if verbose:
+        print(f"Knee: rank {qc['knee_rank']} ({qc['knee_umis']} UMIs); inflection: rank {qc['inflection_rank']} ({qc['inflection_umis']} UMIs)")
 
     fig, ax = plt.subplots(figsize=(10, 7))
 
     ax.loglog(
-        knee,
-        range(len(knee)),
+        qc["umis"],
+        qc["ranks"],
         linewidth=line_width,
         color=line_color
     )
-#     ax.axvline(x=knee[expected_num_cells], linewidth=3, color="k")
-#     ax.axhline(y=expected_num_cells, linewidth=3, color="k")
+    if not np.isnan(qc["knee_rank"]):
+        ax.axhline(y=qc["knee_rank"], linewidth=1, linestyle="--", color="k", label="knee")
+    if not np.isnan(qc["inflection_rank"]):
+        ax.axhline(y=qc["inflection_rank"], linewidth=1, linestyle=":", color="k", label="inflection")
+    if expected_num_cells is not None and len(qc["ranks"]) > 0:
+        ax.axvline(x=np.interp(expected_num_cells, qc["ranks"], qc["umis"]), linewidth=3, color="k")
+        ax.axhline(y=expected_num_cells, linewidth=3, color="k")
 
     ax.set_xlabel("UMI Counts")
     ax.set_ylabel("Set of Barcodes")
@@ -40,8 +72,146 @@ def knee_plot(
     plt.grid(True, which="both")
     plt.show()
 
+# Rasterized embedding plot - bins points into pixels and draws each panel as a single image
+@profiled
+def raster_embedding(
+    adata,
+    color,
+    basis,
+    ax=None,
+    resolution=400,
+    agg="mean",
+    groups=None,
+    cmap="viridis",
+    vmin=None,
+    vmax=None,
+    na_color='lightgrey',
+    layer=None,
+    title=None,
+    frameon=False,
+    legend_loc="right margin",
+    colorbar=True,
+    show=None,
+    **kwargs
+):
+    """
+    Plot an embedding as an aggregated raster instead of a scatter plot. Points are binned into a
+    `resolution`-pixel wide grid with NumPy, so time and memory stay flat for 10^5-10^6 points.
+
+    Parameters:
+        adata (AnnData): Anndata object with the embedding in adata.obsm.
+        color (str): Gene or obs column to color by.
+        basis (str): Embedding to plot (e.g. 'umap' or 'X_umap').
+        ax (matplotlib.axes.Axes): Axes to draw into. If None, a new figure is created.
+        resolution (int): Number of pixels along the longer side of the embedding.
+        agg (str): How numeric values are aggregated per pixel, 'mean' or 'max'.
+        groups (list): For categorical `color`, categories drawn on top (a pixel shows the most frequent of these if any is present).
+        cmap, vmin, vmax: Color map and limits for numeric values.
+        na_color: Color of the categories not in `groups`, when `groups` is given and no palette is stored.
+        layer (str): Layer to read gene values from.
+        title (str): Panel title. Default is `color`.
+        frameon (bool): Whether to draw the axes frame.
+        legend_loc (str): 'right margin' to draw a legend for categorical values, None to hide it.
+        colorbar (bool): Whether to draw a colorbar for numeric values.
+        show (bool): If True, call plt.show().
+        **kwargs: Ignored; accepted so that scanpy.pl.embedding arguments (size, sort_order, ...) can be passed through.
+
+    Returns:
+        The matplotlib Axes.
+    """
+    from matplotlib.colors import to_rgba
+    from matplotlib.patches import Patch
+
+    basis_key = basis if basis in adata.obsm else 'X_' + basis
+    coords = np.asarray(adata.obsm[basis_key])[:, :2]
+
+    # Pixel grid
+    lo = coords.min(axis=0)
+    hi = coords.max(axis=0)
+    span = np.maximum(hi - lo, 1e-12)
+    nx, ny = (np.maximum(1, np.round(resolution * span / span.max())).astype(int))
+    px = np.minimum(((coords[:, 0] - lo[0]) / span[0] * nx).astype(np.int64), nx - 1)
+    py = np.minimum(((coords[:, 1] - lo[1]) / span[1] * ny).astype(np.int64), ny - 1)
+    pix = py * nx + px
+    n_pix = nx * ny
+
+    if ax is None:
+        fig, ax = plt.subplots()
+
+    if color in adata.obs.columns and adata.obs[color].dtype.name == 'category':
+        cats = adata.obs[color].cat.categories
+        codes = adata.obs[color].cat.codes.values.astype(np.int64)
+        valid = codes >= 0
+        counts = np.bincount(
+            pix[valid] * len(cats) + codes[valid], minlength=n_pix * len(cats)
+        ).reshape(n_pix, len(cats))
+
+        if color+'_colors' in adata.uns:
+            palette = list(adata.uns[color+'_colors'])
+        else:
+            base = plt.get_cmap('tab20')
+            palette = [base(k % 20) for k in range(len(cats))]
+            if groups is not None:
+                palette = [palette[k] if cats[k] in groups else na_color for k in range(len(cats))]
+
+        top = counts.argmax(axis=1)
+        if groups is not None:
+            in_group = np.isin(cats, groups)
+            group_counts = np.where(in_group[None, :], counts, -1)
+            top = np.where(counts[:, in_group].sum(axis=1) > 0, group_counts.argmax(axis=1), top)
+
+        rgba = np.array([to_rgba(c) for c in palette])[top]
+        rgba[counts.sum(axis=1) == 0, 3] = 0 # empty pixels are transparent
+        ax.imshow(
+            rgba.reshape(ny, nx, 4), origin='lower', interpolation='nearest',
+            extent=(lo[0], hi[0], lo[1], hi[1]), aspect='auto'
+        )
+
+        if legend_loc == "right margin":
+            shown = [k for k in range(len(cats)) if groups is None or cats[k] in groups]
+            ax.legend(
+                handles=[Patch(color=palette[k], label=str(cats[k])) for k in shown],
+                loc='center left', bbox_to_anchor=(1, 0.5), frameon=False
+            )
+    else:
+        values = np.asarray(adata.obs_vector(color, layer=layer), dtype=np.float64)
+        n_pts = np.bincount(pix, minlength=n_pix)
+        if agg == "mean":
+            img = np.bincount(pix, weights=values, minlength=n_pix) / np.maximum(n_pts, 1)
+        elif agg == "max":
+            order = np.argsort(pix, kind='stable')
+            starts = np.flatnonzero(np.diff(pix[order], prepend=-1))
+            img = np.zeros(n_pix)
+            img[pix[order][starts]] = np.maximum.reduceat(values[order], starts)
+        else:
+            raise ValueError(f"agg must be 'mean' or 'max', not '{agg}'")
+        img[n_pts == 0] = np.nan # empty pixels are transparent
+
+        # copy, so that a Colormap passed in by the caller is not changed
+        cmap = plt.get_cmap(cmap).copy() if type(cmap) == str else cmap.copy()
+        cmap.set_bad(alpha=0)
+        im = ax.imshow(
+            img.reshape(ny, nx), origin='lower', interpolation='nearest', cmap=cmap,
+            vmin=vmin, vmax=vmax, extent=(lo[0], hi[0], lo[1], hi[1]), aspect='auto'
+        )
+        if colorbar:
+            plt.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+
+    ax.set_title(color if title is None else title)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    if not frameon:
+        for spine in ax.spines.values():
+            spine.set_visible(False)
+
+    if show:
+        plt.show()
+    return ax
+
+
 # Faceted plot for any embedding
 # scanpy github issue reference- https://github.com/scverse/scanpy/issues/955
+@profiled
 def facet_embedding(
     adata, 
     clust_key, 
@@ -49,27 +219,113 @@ def facet_embedding(
     size=60, 
     frameon=False, 
     legend_loc=None, 
+    backend="scanpy",
     **kwargs
 ):
-    # import scanpy as sc
+    """
+    Plot one panel per category of `clust_key`, highlighting that category over the rest of the cells.
+
+    Instead of copying `adata`, a lightweight AnnData holding only the embedding coordinates and one boolean
+    column per category is built, so memory scales with the embedding rather than the expression matrix.
+
+    Parameters:
+        adata (AnnData): Anndata object with the embedding in adata.obsm and colors in adata.uns[f"{clust_key}_colors"].
+        clust_key (str): Categorical obs column to facet by.
+        basis (str): Embedding to plot (e.g. 'umap' or 'X_umap').
+        size, frameon, legend_loc: Passed on to scanpy.pl.embedding.
+        backend (str): 'scanpy' for scatter plots via scanpy.pl.embedding, or 'raster' to draw each panel as an aggregated image (see `raster_embedding`).
+        **kwargs: Additional parameters to be passed to scanpy.pl.embedding (or `raster_embedding`).
+    """
+    clusters = adata.obs[clust_key].cat.categories
+    codes = adata.obs[clust_key].cat.codes.values
+    colors = adata.uns[clust_key+'_colors']
+
+    # All cluster masks in one pass over the categorical codes
+    masks = (codes[:, None] == np.arange(len(clusters))[None, :]).astype(np.int8)
 
-    tmp = adata.copy()
+    obs = pd.DataFrame(
+        {
+            str(clust): pd.Categorical.from_codes(masks[:, i], categories=[False, True])
+            for i, clust in enumerate(clusters)
+        },
+        index=adata.obs_names
+    )
+    uns = {
+        str(clust)+'_colors': ['#d3d3d3', colors[i]]
+        for i, clust in enumerate(clusters)
+    }
 
-    for i,clust in enumerate(adata.obs[clust_key].cat.categories):
-        tmp.obs[clust] = adata.obs[clust_key].isin([clust]).astype('category')
-        tmp.uns[clust+'_colors'] = ['#d3d3d3', adata.uns[clust_key+'_colors'][i]]
+    # Only the embedding coordinates are carried over (no copy of X, layers or graphs)
+    basis_key = basis if basis in adata.obsm else 'X_' + basis
+    tmp = AnnData(obs=obs, obsm={basis_key: adata.obsm[basis_key]}, uns=uns)
+
+    if backend == "raster":
+        ncols = kwargs.pop("ncols", 4)
+        # figure-level options apply once to the whole grid, not to each panel
+        show = kwargs.pop("show", None)
+        save = kwargs.pop("save", None)
+        return_fig = kwargs.pop("return_fig", False)
+        nrows = int(np.ceil(len(clusters) / ncols))
+        fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(4 * ncols, 4 * nrows), squeeze=False)
+        axes = axes.flatten()
+        for i, clust in enumerate(clusters):
+            raster_embedding(
+                tmp, color=str(clust), basis=basis, ax=axes[i], groups=[True],
+                frameon=frameon, legend_loc=legend_loc, **kwargs
+            )
+        for ax in axes[len(clusters):]:
+            ax.set_visible(False)
+        if save:
+            fig.savefig(save if isinstance(save, str) else "facet_embedding.png", bbox_inches="tight")
+        if return_fig:
+            return fig
+        if show is not False:
+            plt.show()
+        return
 
     sc.pl.embedding(
         tmp, 
-        groups=tmp.obs[clust].cat.categories[1:].values, 
-        color=adata.obs[clust_key].cat.categories.tolist(), 
+        groups=[True], 
+        color=[str(clust) for clust in clusters], 
         basis=basis,
         size=size, frameon=frameon, legend_loc=legend_loc, 
         **kwargs
     )
 
 
+# Gather the features needed for plotting into a lightweight AnnData (one batched column gather for all genes)
+def _embedding_subset(
+        adata, 
+        features, 
+        basis, 
+        layer=None, 
+        use_raw=False
+    ):
+    source = adata.raw if use_raw else adata
+    genes = [feat for feat in features if feat in source.var_names and feat not in adata.obs.columns]
+    obs_cols = [feat for feat in features if feat in adata.obs.columns]
+
+    idx = source.var_names.get_indexer(genes)
+    mtx = source.X if (layer is None or use_raw) else adata.layers[layer]
+    block = mtx[:, idx]
+    block = block.toarray() if hasattr(block, "toarray") else np.asarray(block)
+
+    basis_key = basis if basis in adata.obsm else 'X_' + basis
+    uns = {
+        feat+'_colors': adata.uns[feat+'_colors'] 
+        for feat in obs_cols if feat+'_colors' in adata.uns
+    }
+    return AnnData(
+        X=block,
+        obs=adata.obs[obs_cols],
+        var=pd.DataFrame(index=genes),
+        obsm={basis_key: adata.obsm[basis_key]},
+        uns=uns
+    )
+
+
 # scanpy version of seuListPlot - grids of plots for a single embedding
+@profiled
 def plot_grid_of_embeddings(
         adata_dict, 
         color, 
@@ -79,18 +335,23 @@ def plot_grid_of_embeddings(
         na_color='lightgrey', 
         # cmap="plasma", 
         same_scale=False, 
+        backend="scanpy",
         **kwargs
     ):
     """
     Plot a grid of embeddings for multiple Anndata objects.
 
+    All requested genes are pulled from each Anndata object in one batched column gather before plotting; the
+    shared color limits (same_scale=True) and the panels themselves are computed from these extracted values.
+
     Parameters:
         adata_dict (dict): Dictionary of Anndata objects. The keys represent the plot titles and the values are the corresponding Anndata objects.
         color (list): List of feature names to use for coloring the embeddings.
         ncols (int): Number of columns in the grid. If None, it is set to the number of entries in adata_dict.
         figsize (tuple): Figure size (width, height).
         same_scale (bool): If True, use the same color scale for plots showing the same feature.
-        **kwargs: Additional parameters to be passed to scanpy.pl.embedding.
+        backend (str): 'scanpy' for scatter plots via scanpy.pl.embedding, or 'raster' to draw each panel as an aggregated image (see `raster_embedding`).
+        **kwargs: Additional parameters to be passed to scanpy.pl.embedding or `raster_embedding` (`basis` is required; `layer` and `use_raw` select where gene values are read from).
 
     """
 
@@ -108,47 +369,60 @@ def plot_grid_of_embeddings(
             sharex=True, 
             sharey='row'
         )
-        axes = axes.flatten()
+        axes = np.asarray(axes).flatten()
     else:
         print("Need to specify `color`")
+        return
 
-    for i, feat in enumerate(color):
-        if same_scale:
-            # Find color scale range for current `feat`
-            color_min = np.inf
-            color_max = -np.inf
-            for j, (title, adata) in enumerate(adata_dict.items()):
-                # Find the min and max values of feat within each adata object
-                if feat in adata.obs_names and adata.obs[feat].dtype.name != 'category': # metadata variables
-                    feat_min = np.min(adata.obs[feat])
-                    feat_max = np.max(adata.obs[feat])
-                elif feat in adata.var_names: # gene expression
-                    feat_min = np.min(adata[:, feat].X)
-                    feat_max = np.max(adata[:, feat].X)
+    # Precompute: extract every requested feature once per Anndata object
+    layer = kwargs.pop("layer", None)
+    use_raw = kwargs.pop("use_raw", False)
+    subset_dict = {
+        title: _embedding_subset(adata, list(color), kwargs["basis"], layer=layer, use_raw=use_raw)
+        for title, adata in adata_dict.items()
+    }
+
+    if same_scale:
+        # Color scale ranges for every feature, from the extracted values
+        color_min = {feat: np.inf for feat in color}
+        color_max = {feat: -np.inf for feat in color}
+        for title, tmp in subset_dict.items():
+            if tmp.n_vars > 0:
+                feat_min = np.nanmin(tmp.X, axis=0)
+                feat_max = np.nanmax(tmp.X, axis=0)
+                for k, feat in enumerate(tmp.var_names):
+                    color_min[feat] = min(color_min[feat], feat_min[k])
+                    color_max[feat] = max(color_max[feat], feat_max[k])
+            for feat in tmp.obs.columns:
+                if tmp.obs[feat].dtype.name != 'category': # metadata variables
+                    feat_min = np.min(tmp.obs[feat])
+                    feat_max = np.max(tmp.obs[feat])
                 else: # categorical variables
                     feat_min = 0 #None
                     feat_max = 42 #None
-                color_min = min(color_min, feat_min)
-                color_max = max(color_max, feat_max)
+                color_min[feat] = min(color_min[feat], feat_min)
+                color_max[feat] = max(color_max[feat], feat_max)
+
+    # Set 
+    if kwargs.get("cmap") is not None and type(kwargs["cmap"]) == str:
+        kwargs["cmap"] = plt.get_cmap(kwargs["cmap"]).copy()
+        kwargs["cmap"].set_under(na_color)
 
-        for j, (title, adata) in enumerate(adata_dict.items()):
+    for i, feat in enumerate(color):
+        for j, (title, tmp) in enumerate(subset_dict.items()):
             ax = axes[i * ncols + j]
             ax.set_aspect('equal')
 
             # Set color limits for the plot
-            vmin = color_min if same_scale else None
-            vmax = color_max if same_scale else None
-            
-            # Set 
-            if kwargs["cmap"] is not None and type(kwargs["cmap"]) == str:
-                kwargs["cmap"] = cm.get_cmap(kwargs["cmap"])
-                kwargs["cmap"].set_under(na_color)
+            vmin = color_min[feat] if same_scale and np.isfinite(color_min[feat]) else None
+            vmax = color_max[feat] if same_scale and np.isfinite(color_max[feat]) else None
                 
             if min_value != None:
                 vmin = min_value
 
-            sc.pl.embedding(
-                adata,
+            plot_fn = raster_embedding if backend == "raster" else sc.pl.embedding
+            plot_fn(
+                tmp,
                 color=feat,
                 title=None,
                 show=False,
@@ -176,5 +450,3 @@ def plot_grid_of_embeddings(
     plt.tight_layout()
     # plt.legend(loc='right')
     plt.show()
-
-
@@ -0,0 +1,223 @@
+# Opt-in timing/memory instrumentation for the functions in utils.py and plots.py
+#
+# Profiling is off by default; the decorator then only checks a flag before calling through.
+#   from scripts.py.profiling import enable_profiling, profiling_table
+#   enable_profiling(memory=True)   # or set the environment variable SCCO_PROFILE=1 (SCCO_PROFILE=memory to also trace allocations)
+#   ... run the notebook ...
+#   profiling_table()               # one row per call
+import functools
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+_SETTINGS = {
+    "enabled": os.environ.get("SCCO_PROFILE", "") not in ["", "0"],
+    "memory": os.environ.get("SCCO_PROFILE", "") == "memory",
+    "to_uns": False
+}
+_RECORDS = []
+_LOCAL = threading.local() # per-thread stack of open profiled calls
+
+
+def enable_profiling(
+    memory: bool = False,
+    to_uns: bool = False
+):
+    """
+    Turn on profiling of the decorated functions.
+
+    Args:
+        memory (bool, optional): Also trace Python/NumPy allocations with tracemalloc (slower). Default is False.
+        to_uns (bool, optional): Also append each record to adata.uns['profiling'] when the first argument is an AnnData object. Default is False.
+    """
+    _SETTINGS.update(enabled=True, memory=memory, to_uns=to_uns)
+
+
+def disable_profiling():
+    """Turn off profiling. Records collected so far are kept."""
+    _SETTINGS["enabled"] = False
+
+
+def clear_profiling():
+    """Drop all collected records."""
+    _RECORDS.clear()
+
+
+def profiling_table() -> pd.DataFrame:
+    """
+    Collected records as a table: one row per call, with the function name, nesting depth, process (main or worker),
+    wall time, peak RSS during the call and its increase over the RSS at the start, peak traced allocation (if
+    memory tracing is on) and input shapes. 'rss_scope' is 'call' when the peak RSS could be measured per call
+    (Linux), and 'process' when it is the process-lifetime maximum instead.
+    """
+    return pd.DataFrame(_RECORDS)
+
+
+# Resident set size (current, peak) in MB. The peak is per call where the kernel allows resetting it (Linux),
+# otherwise the process-lifetime maximum.
+def _read_rss():
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if line.startswith(("VmRSS", "VmHWM")))
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# Short description of the shapes of the inputs to a call
+def _describe_inputs(args, kwargs) -> str:
+    def _shape(x):
+        if hasattr(x, "shape") and not isinstance(x, (str, bytes)):
+            try:
+                return str(tuple(x.shape))
+            except TypeError:
+                return None
+        if isinstance(x, (list, tuple, dict)):
+            return f"len={len(x)}"
+        return None
+
+    parts = [f"arg{i}={s}" for i, s in enumerate(map(_shape, args)) if s is not None]
+    parts += [f"{k}={s}" for k, s in ((k, _shape(v)) for k, v in kwargs.items()) if s is not None]
+    return ", ".join(parts)
+
+
+def _stack():
+    if not hasattr(_LOCAL, "stack"):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+def _record(record, args):
+    _RECORDS.append(record)
+    logger.debug("%s took %.3f s (%s)", record["function"], record["wall_time_s"], record["inputs"])
+
+    if _SETTINGS["to_uns"] and len(args) > 0 and hasattr(args[0], "uns") and hasattr(args[0], "obs"):
+        # columnar, so that it can be written to .h5ad
+        uns = args[0].uns.setdefault("profiling", {})
+        for key, value in record.items():
+            uns[key] = list(uns.get(key, [])) + [value if value is not None else float("nan")]
+
+
+@contextmanager
+def profile_block(name: str, *args, **kwargs):
+    """
+    Context manager recording a block of code under `name` (no-op when profiling is off). Extra arguments are only
+    used to describe input shapes.
+
+    Peak RSS and traced allocations are reset at the start of each block; the peak seen so far by the enclosing
+    block is saved first and handed back at the end, so nested blocks do not distort each other's peaks.
+    """
+    if not _SETTINGS["enabled"]:
+        yield
+        return
+
+    stack = _stack()
+    parent = stack[-1] if len(stack) > 0 else None
+    frame = {"rss_peak": 0.0, "alloc_peak": 0}
+
+    start_tracing = _SETTINGS["memory"] and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    tracing = _SETTINGS["memory"]
+    if tracing:
+        alloc_now, alloc_peak = tracemalloc.get_traced_memory()
+        if parent is not None:
+            parent["alloc_peak"] = max(parent["alloc_peak"], alloc_peak)
+        tracemalloc.reset_peak()
+        frame["alloc_start"] = alloc_now
+
+    rss_now, rss_peak = _read_rss()
+    if parent is not None:
+        parent["rss_peak"] = max(parent["rss_peak"], rss_peak)
+    per_call = _reset_peak_rss()
+    frame["rss_start"] = rss_now
+
+    stack.append(frame)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - t0
+        stack.pop()
+
+        peak_rss = max(frame["rss_peak"], _read_rss()[1])
+        peak_alloc = None
+        if tracing:
+            alloc_peak = max(frame["alloc_peak"], tracemalloc.get_traced_memory()[1])
+            peak_alloc = (alloc_peak - frame["alloc_start"]) / 1024**2
+            if parent is not None:
+                parent["alloc_peak"] = max(parent["alloc_peak"], alloc_peak)
+        if start_tracing:
+            tracemalloc.stop()
+        if parent is not None:
+            parent["rss_peak"] = max(parent["rss_peak"], peak_rss)
+
+        _record({
+            "function": name,
+            "depth": len(stack),
+            "process": "main",
+            "wall_time_s": wall,
+            "peak_rss_mb": peak_rss,
+            "rss_delta_mb": peak_rss - frame["rss_start"],
+            "rss_scope": "call" if per_call else "process",
+            "peak_alloc_mb": peak_alloc,
+            "inputs": _describe_inputs(args, kwargs)
+        }, args)
+
+
+def profiled(func):
+    """Decorator recording each call of `func` when profiling is enabled."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _SETTINGS["enabled"]:
+            return func(*args, **kwargs)
+        with profile_block(func.__name__, *args, **kwargs):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Run `func` in a worker process and send its profiling records back along with the result
+def worker_call(func, *args, **kwargs):
+    """
+    Submit this (e.g. `pool.submit(worker_call, func, *args)`) instead of `func` itself, and pass each result through
+    collect_worker_records() in the parent, so that records made in worker processes are not lost.
+    """
+    if not _SETTINGS["enabled"]:
+        return func(*args, **kwargs), []
+
+    n_before = len(_RECORDS)
+    base_depth = len(_stack())
+    with profile_block(getattr(func, "__name__", str(func)), *args, **kwargs):
+        out = func(*args, **kwargs)
+    records = [
+        {**r, "depth": r["depth"] - base_depth, "process": f"worker-{os.getpid()}"}
+        for r in _RECORDS[n_before:]
+    ]
+    del _RECORDS[n_before:]
+    return out, records
+
+
+def collect_worker_records(packed):
+    """Unpack a worker_call() result: store its records under the current call and return the function's result."""
+    out, records = packed
+    depth = len(_stack())
+    _RECORDS.extend({**r, "depth": r["depth"] + depth} for r in records)
+    return out
@@ -5,10 +5,23 @@ import pandas as pd
 import numpy as np
 from matplotlib.path import Path
 from scipy.sparse import issparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from typing import Union
 import scipy.sparse as sp
+import warnings
+try:
+    from .profiling import profiled, worker_call, collect_worker_records
+except ImportError:
+    from profiling import profiled, worker_call, collect_worker_records
 
 
+# Per-dimension variance of a reduction
+def _reduction_variance(ADATA, reduction="pca") -> np.ndarray:
+    return np.asarray(ADATA.obsm[reduction]).var(axis=0)
+
+
+@profiled
 def npcs(
         ADATA, 
         var_perc=0.95, 
@@ -27,25 +40,62 @@ def npcs(
     -------
     n_pcs -- The number of PCs needed to cover the specified proportion of the variance. If the specified 'reduction' is not found, returns None.
     """
-    from numpy import sum, var
-    get_var = lambda i: var(ADATA.obsm[reduction][:,i])
-
-    if ADATA.obsm[reduction] is None:
+    if reduction not in ADATA.obsm or ADATA.obsm[reduction] is None:
         print(f"Reduction '{reduction}', not found!")
         return None
     else:
-        var_tmp = [get_var(i) for i in list(range(0,ADATA.obsm[reduction].shape[1]))]
-        var_cut = var_perc * sum(var_tmp)
-        n_pcs = 0
-        var_sum = 0
-        while var_sum<var_cut and n_pcs<ADATA.obsm[reduction].shape[1]-1:
-            var_sum = var_sum + var_tmp[n_pcs]
-            n_pcs = n_pcs + 1
+        var_tmp = _reduction_variance(ADATA, reduction)
+        var_cum = np.cumsum(var_tmp)
+        var_cut = var_perc * var_cum[-1]
+        if var_cut <= 0:
+            return 0
+        n_pcs = int(np.searchsorted(var_cum, var_cut, side="left")) + 1
+
+        return(min(n_pcs, len(var_tmp) - 1))
+
+
+# Cumulative explained-variance curves for several reductions
+@profiled
+def variance_profile(
+        ADATA,
+        reductions=None,
+        cumulative=True
+    ) -> pd.DataFrame:
+    """
+    Get the (cumulative) fraction of variance explained by each dimension, for several reductions at once.
+    Useful for choosing `n_pcs` for sc.pp.neighbors.
+    
+    Parameters:
+    -------
+    ADATA -- An AnnData object containing the reductions in its 'obsm' field.
+    reductions -- A list of reduction names (keys in ADATA.obsm). If None, ['pca'] is used. Default is None.
+    cumulative -- If True, return the cumulative fraction of variance; otherwise the fraction per dimension. Default is True.
+    
+    Returns:
+    -------
+    profile -- A DataFrame with one row per dimension (1-based) and one column per reduction. Reductions with fewer dimensions are padded with NaN.
+    """
+    if reductions is None:
+        reductions = ["pca"]
+    elif isinstance(reductions, str):
+        reductions = [reductions]
+
+    curves = {}
+    for reduction in reductions:
+        if reduction not in ADATA.obsm:
+            print(f"The reduction '{reduction}' was not found...")
+            continue
+        frac = _reduction_variance(ADATA, reduction)
+        frac = frac / frac.sum()
+        curves[reduction] = pd.Series(np.cumsum(frac) if cumulative else frac, index=np.arange(1, len(frac) + 1))
 
-        return(n_pcs)
+    profile = pd.DataFrame(curves)
+    profile.index.name = "n_dims"
+    return profile
 
 
 # Reorder a reduction by decreasing % variance
+@profiled
 def reorder_reduction(
         ADATA, 
         reduction="pca",
@@ -63,128 +113,458 @@ def reorder_reduction(
     This function doesn't return anything, but it modifies the AnnData object in place, re-ordering the dimensions
     of the specified reduction in the 'obsm' field based on their variance (in decreasing order).
     """
-    from numpy import var, argsort
-
     if reduction in ADATA.obsm:
-        get_var = lambda i: var(ADATA.obsm[reduction][:,i])
-        var_tmp = [get_var(i) for i in list(range(0,ADATA.obsm[reduction].shape[1]))]
+        var_tmp = _reduction_variance(ADATA, reduction)
         if verbose:
             print("Reduction variance by dimension:")
-            print(var_tmp)
+            print(var_tmp.tolist())
 
-        pc_order = argsort(var_tmp)[::-1]
+        pc_order = np.argsort(var_tmp, kind="stable")[::-1]
         ADATA.obsm[reduction] = ADATA.obsm[reduction][:,pc_order]
     else:
         print(f"The reduction '{reduction}' was not found...")
 
 
+# Cache of parsed/filtered gene lists, keyed on (file, mtime, names2check hash, return_indices)
+_GENE_LIST_CACHE = {}
+
 # Read in a list of gene lists from .csv (each column is a gene list)
+@profiled
 def read_csv_to_dict(
         filename, 
-        names2check=""
+        names2check="",
+        return_indices=False,
+        use_cache=True
     ):
     """
     Read in a list of gene lists from .csv (each column is a gene list).
+
+    The file is parsed column-wise with pandas and genes are matched against `names2check` with a hashed index lookup.
+    Results are memoized per (file, modification time, names2check), so repeated calls against the same
+    `adata.var_names` are free.
     
     Parameters:
     -------
     filename -- A string specifying the location of the csv file.
-    names2check -- A list of gene names to filter the dictionary by. If not specified, all gene names are included. 
+    names2check -- A list of gene names to filter the dictionary by (e.g. adata.var_names). If not specified, all gene names are included. 
+    return_indices -- If True, also return the integer positions of the genes in `names2check`. Requires `names2check`. Default is False.
+    use_cache -- If True, reuse previously parsed results for the same file and `names2check`. Default is True.
 
     Returns:
     -------
     dict_out -- A dictionary with column headers from the csv file as keys, and lists of genes as values. If names2check is specified, only genes in names2check are included in the lists.
+    dict_idx -- (only if return_indices=True) A dictionary with the same keys, and integer arrays of the genes' positions in `names2check`.
     """
-    import csv
-
-    # Open the CSV file
-    with open(filename, 'r') as file:
-
-        # Create a CSV reader object
-        reader = csv.reader(file)
-
-        # Read the first row as header
-        header = next(reader)
-
-        # Create an empty dictionary to store the columns
-        dict_out = {col: [] for col in header}
-
-        # Loop through each row in the CSV file
-        for row in reader:
-
-            # Loop through each column in the row
-            for col, value in zip(header, row):
-
-                # Add the value to the corresponding column in the dictionary
-                if value: # skip empty strings
-                    dict_out[col].append(value)
-
-    # Filter out unwanted entries based on the list in `names2check`
-    if len(names2check) > 1:
-        for KEY in dict_out.keys():
-            dict_out[KEY] = [k for k in dict_out[KEY] if k in names2check]
+    import os
+    import hashlib
+
+    check = len(names2check) > 0
+    if return_indices and not check:
+        raise ValueError("`names2check` is required when return_indices=True")
+
+    if use_cache:
+        names_hash = ""
+        if check:
+            names_hash = hashlib.sha1(
+                pd.util.hash_array(np.asarray(names2check, dtype=object)).tobytes()
+            ).hexdigest()
+        key = (os.path.abspath(filename), os.stat(filename).st_mtime_ns, names_hash, return_indices)
+        if key in _GENE_LIST_CACHE:
+            cached = _GENE_LIST_CACHE[key]
+            if return_indices:
+                return ({k: list(v) for k, v in cached[0].items()}, {k: v.copy() for k, v in cached[1].items()})
+            return {k: list(v) for k, v in cached.items()}
+
+    # Read all columns at once; keep gene names like "NA" as strings, and headers as written
+    df = pd.read_csv(filename, dtype=str, keep_default_na=False, header=None).fillna("")
+    header = df.iloc[0].tolist()
+    df = df.iloc[1:]
+
+    if check:
+        # Position of the first occurrence of each name, for hashed lookups
+        first_pos = pd.Series(np.arange(len(names2check)), index=pd.Index(np.asarray(names2check, dtype=object)))
+        first_pos = first_pos[~first_pos.index.duplicated()]
+
+    dict_out = {}
+    dict_idx = {}
+    for j, col in enumerate(header):
+        genes = df[j].values
+        genes = genes[genes != ""] # skip empty strings
+        if check:
+            pos = first_pos.index.get_indexer(genes)
+            genes = genes[pos >= 0]
+            dict_idx[col] = np.concatenate([dict_idx.get(col, []), first_pos.values[pos[pos >= 0]]]).astype(np.int64)
+        dict_out[col] = dict_out.get(col, []) + genes.tolist()
+
+    if use_cache:
+        _GENE_LIST_CACHE[key] = (dict_out, dict_idx) if return_indices else dict_out
+        dict_out = {k: list(v) for k, v in dict_out.items()}
+        dict_idx = {k: v.copy() for k, v in dict_idx.items()}
 
     # Return the dictionary
+    if return_indices:
+        return dict_out, dict_idx
     return dict_out
 
 
+# Pull the top `n_features` rows of one group straight from the DGEA record arrays
+def _dgea_group_frame(result, group, n_features, fields):
+    df = pd.DataFrame({
+        key: np.asarray(result[key][group][:n_features])
+        for key in fields
+    })
+    if "pts" in result:
+        # same columns as sc.get.rank_genes_groups_df
+        df["pct_nz_group"] = result["pts"][group].reindex(df["names"]).values
+        if "pts_rest" in result:
+            df["pct_nz_reference"] = result["pts_rest"][group].reindex(df["names"]).values
+    return df
+
+
 # Function to export DGEA results to a .csv file
+@profiled
 def export_dgea_to_csv(
     adata: ad.AnnData,
     dgea_name,
     n_features,
     csv_out,
     axis=0,
-    wide=False
+    wide=False,
+    fields=None,
+    out_format=None,
+    compression=None
 ):
     """
-    Function to export DGEA (Differential Gene Expression Analysis) results to a .csv file.
+    Function to export DGEA (Differential Gene Expression Analysis) results to a .csv (or .parquet) file.
+
+    Rows are sliced straight out of the record arrays in adata.uns[dgea_name] (with `n_features` applied up front)
+    and, in long format, streamed to the output file one group at a time.
     
     Parameters:
     -------
     adata -- An AnnData object which stores the gene expression data and metadata.
-    dgea_name -- A string specifying the name of the DGEA results in adata.uns[].
-    n_features -- An integer specifying the number of top features to be included in the exported .csv file.
-    csv_out -- A string specifying the path to the output .csv file.
+    dgea_name -- A string specifying the name of the DGEA results in adata.uns[], or a list of names to export together (a 'dgea' column records the source of each row).
+    n_features -- An integer specifying the number of top features to be included in the exported .csv file. If None, all features are written.
+    csv_out -- A string specifying the path to the output .csv file. Files ending in '.gz' are gzip-compressed.
     axis -- An integer specifying how to write results for each group. If 1, results are written horizontally. If 0, results are written vertically. Default is 0.
     wide -- A boolean specifying the format of the .csv file. If True, the .csv file will have one row per feature, and each column will be a group. If False, the .csv file will have one row per group-feature combination. Default is False.
+    fields -- List of per-gene fields to export (missing ones are skipped). 'pct_nz_group'/'pct_nz_reference' are added when `pts` was computed. If None, ['names', 'scores', 'logfoldchanges', 'pvals', 'pvals_adj'] is used. Default is None.
+    out_format -- 'csv' or 'parquet'. If None, inferred from the extension of `csv_out`. Parquet output requires pyarrow. Default is None.
+    compression -- Compression codec for parquet output. Default is None (pyarrow's default, snappy).
 
     Returns:
     -------
     The function doesn't return anything but writes the DGEA results to a .csv file.
     """
-    import pandas as pd
-    import scanpy as sc
-
-    result = adata.uns[dgea_name]
-    groups = result['names'].dtype.names
+    import gzip
+
+    if fields is None:
+        fields = ['names', 'scores', 'logfoldchanges', 'pvals', 'pvals_adj']
+    dgea_names = [dgea_name] if isinstance(dgea_name, str) else list(dgea_name)
+    if out_format is None:
+        out_format = "parquet" if str(csv_out).endswith(".parquet") else "csv"
+
+    # Shared column layout, so that rows from every key/group line up
+    columns = [key for key in fields if any(key in adata.uns[name] for name in dgea_names)]
+    for key, pct_col in [("pts", "pct_nz_group"), ("pts_rest", "pct_nz_reference")]:
+        if any(key in adata.uns[name] for name in dgea_names):
+            columns.append(pct_col)
+    columns += ['celltypes'] + (['dgea'] if len(dgea_names) > 1 else [])
+
+    def _frames():
+        # Yield one DataFrame per (dgea key, group), already cut to n_features
+        for name in dgea_names:
+            result = adata.uns[name]
+            keys = [key for key in fields if key in result]
+            for group in result['names'].dtype.names:
+                markers = _dgea_group_frame(result, group, n_features, keys)
+                markers['celltypes'] = group
+                if len(dgea_names) > 1:
+                    markers['dgea'] = name
+                yield markers.reindex(columns=columns)
 
     if wide:
-        celltype_markers = pd.DataFrame(
-            {group + '_' + key[:-1]: result[key][group]
-            for group in groups for key in ['names', 'logfoldchanges','pvals']}).head(n_features)
-        celltype_markers.to_csv(csv_out, index=False)
+        celltype_markers = pd.DataFrame({
+            (name + '_' if len(dgea_names) > 1 else '') + group + '_' + key[:-1]: adata.uns[name][key][group][:n_features]
+            for name in dgea_names
+            for group in adata.uns[name]['names'].dtype.names
+            for key in ['names', 'logfoldchanges', 'pvals']
+        })
+        if out_format == "parquet":
+            celltype_markers.to_parquet(csv_out, index=False, compression=compression)
+        else:
+            celltype_markers.to_csv(csv_out, index=False)
+    elif axis == 1:
+        # Groups side by side can't be streamed row-wise
+        celltype_markers = pd.concat(list(_frames()), axis=axis)
+        if out_format == "parquet":
+            celltype_markers.to_parquet(csv_out, index=False, compression=compression)
+        else:
+            celltype_markers.to_csv(csv_out, index=False)
+    elif out_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Explicit schema from the record array dtypes, so a first group with empty or all-missing columns can't
+        # fix the wrong types for the whole file
+        def _arrow_type(col):
+            if col in ['celltypes', 'dgea']:
+                return pa.string()
+            if col in ['pct_nz_group', 'pct_nz_reference']:
+                return pa.float64()
+            dtype = next(adata.uns[name][col].dtype[0] for name in dgea_names if col in adata.uns[name])
+            return pa.string() if dtype.kind in 'OUS' else pa.from_numpy_dtype(dtype)
+
+        schema = pa.schema([(col, _arrow_type(col)) for col in columns])
+        with pq.ParquetWriter(csv_out, schema, compression=compression or "snappy") as writer:
+            for markers in _frames():
+                writer.write_table(pa.Table.from_pandas(markers, schema=schema, preserve_index=False))
     else:
-        marker_list = list()
-        for group in adata.uns[dgea_name]['names'].dtype.names:
-            markers = sc.get.rank_genes_groups_df(adata, key=dgea_name, group = group).head(n_features)
-            markers['celltypes'] = group
-            marker_list.append(markers)
-        
-        celltype_markers = pd.concat(
-            marker_list, 
-            axis=axis
+        opener = gzip.open if str(csv_out).endswith(".gz") else open
+        with opener(csv_out, 'wt', newline='') as handle:
+            for i, markers in enumerate(_frames()):
+                markers.to_csv(handle, index=False, header=(i == 0))
+
+
+# Per-group Wilcoxon rank sums for one block of genes; module-level so it can be sent to worker processes
+def _wilcoxon_block(block, codes, n_groups):
+    """
+    `block` is a (cells x genes) CSC matrix and `codes` the group code of each cell. Only the nonzero values are
+    ranked; the zeros of each gene form one tied block. Returns per-group rank sums, nonzero counts and value sums
+    (genes x groups), and each gene's tie term sum(t^3 - t).
+    """
+    block = sp.csc_matrix(block, dtype=np.float64)
+    block.eliminate_zeros()
+    n_cells, n_genes = block.shape
+    nnz = np.diff(block.indptr)
+    col = np.repeat(np.arange(n_genes), nnz)
+
+    # Sort by (gene, value) and average the ranks of tied values
+    order = np.lexsort((block.data, col))
+    values, col, rows = block.data[order], col[order], block.indices[order]
+    pos = np.arange(len(values)) - block.indptr[col]
+    new_tie = np.r_[True, (values[1:] != values[:-1]) | (col[1:] != col[:-1])]
+    tie_id = np.cumsum(new_tie) - 1
+    tie_size = np.bincount(tie_id)
+    ranks = (pos[new_tie] + (tie_size + 1) / 2)[tie_id]
+
+    # Place the zero block: negative values rank below it, positive values above it
+    n_zero = n_cells - nnz
+    n_neg = np.bincount(col[values < 0], minlength=n_genes)
+    ranks = ranks + np.where(values > 0, n_zero[col], 0)
+    zero_rank = n_neg + (n_zero + 1) / 2
+
+    flat = col * n_groups + codes[rows]
+    size = n_genes * n_groups
+    rank_sums = np.bincount(flat, weights=ranks, minlength=size).reshape(n_genes, n_groups)
+    nnz_group = np.bincount(flat, minlength=size).reshape(n_genes, n_groups)
+    value_sums = np.bincount(flat, weights=values, minlength=size).reshape(n_genes, n_groups)
+
+    n_group = np.bincount(codes, minlength=n_groups)
+    rank_sums += (n_group[None, :] - nnz_group) * zero_rank[:, None]
+
+    ties = np.bincount(col[new_tie], weights=tie_size.astype(np.float64) ** 3 - tie_size, minlength=n_genes)
+    ties += n_zero.astype(np.float64) ** 3 - n_zero
+    return rank_sums, nnz_group, value_sums, ties
+
+
+# Benjamini-Hochberg adjusted p-values
+def _bh_adjust(pvals):
+    n = len(pvals)
+    order = np.argsort(pvals)
+    adjusted = np.minimum.accumulate((pvals[order] * n / np.arange(1, n + 1))[::-1])[::-1]
+    out = np.empty(n)
+    out[order] = np.minimum(adjusted, 1)
+    return out
+
+
+# One-vs-rest Wilcoxon rank-sum test for every group, with a single ranking pass per gene
+@profiled
+def rank_genes_wilcoxon(
+    adata,
+    groupby: str,
+    layer=None,
+    n_genes=None,
+    key_added: str = "rank_genes_groups",
+    pts: bool = True,
+    tie_correct: bool = False,
+    gene_block: int = 1000,
+    n_jobs=None,
+    verbose: bool = True
+):
+    """
+    Faster equivalent of sc.tl.rank_genes_groups(..., method='wilcoxon') with reference='rest'.
+
+    Each gene's nonzero values are ranked once (zeros are one tied block, so only the nonzeros are sorted), and
+    the U statistics of all groups come from per-group rank sums. Log fold changes and percent-expressed are
+    computed in the same pass. Blocks of `gene_block` genes are spread over a process pool. The results are stored in
+    adata.uns[key_added] with the same layout as scanpy's (record arrays 'names', 'scores', 'logfoldchanges',
+    'pvals', 'pvals_adj', and 'pts'/'pts_rest' DataFrames), so they can be written with export_dgea_to_csv.
+
+    Args:
+        adata (AnnData): The AnnData object with log-normalized expression (may be backed; it is then read once in row blocks).
+        groupby (str): Categorical obs column with the groups. Cells without a group only count towards the rest (as in scanpy).
+        layer (str, optional): Layer to test instead of adata.X. Default is None.
+        n_genes (int, optional): Number of top genes stored per group. Default is None (all genes).
+        key_added (str, optional): Key in adata.uns for the results. Default is "rank_genes_groups".
+        pts (bool, optional): Store the fraction of cells expressing each gene in the group ('pts') and in the rest ('pts_rest'). Default is True.
+        tie_correct (bool, optional): Apply the tie correction to the z-scores. Default is False (as in scanpy).
+        gene_block (int, optional): Number of genes per task. Default is 1000.
+        n_jobs (int, optional): Number of worker processes. 1 runs in this process. Default is None (one per core).
+        verbose (bool, optional): Print progress. Default is True.
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    from scipy.stats import norm
+
+    groups = adata.obs[groupby].astype("category")
+    categories = groups.cat.categories
+    n_groups = len(categories)
+    # cells without a group get an extra code, dropped from the results
+    codes = groups.cat.codes.values.astype(np.int64)
+    codes[codes < 0] = n_groups
+
+    # Cells x genes, column-compressed for per-gene access
+    X = adata.X if layer is None else adata.layers[layer]
+    if isinstance(X, np.ndarray) or issparse(X):
+        X = sp.csc_matrix(X)
+    else:
+        X = sp.vstack([
+            sp.csr_matrix(np.asarray(block) if not issparse(block) else block)
+            for start, stop, block in _iter_row_blocks(X)
+        ]).tocsc()
+
+    blocks = [(start, min(start + gene_block, adata.n_vars)) for start in range(0, adata.n_vars, gene_block)]
+    if verbose:
+        print(f"Ranking {adata.n_vars} genes in {len(blocks)} blocks for {n_groups} groups...")
+
+    if n_jobs is None:
+        n_jobs = min(len(blocks), os.cpu_count() or 1)
+    args = [(X[:, start:stop], codes, n_groups + 1) for start, stop in blocks]
+    if n_jobs == 1:
+        results = [_wilcoxon_block(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+            results = [collect_worker_records(r) for r in pool.map(worker_call, [_wilcoxon_block] * len(args), *zip(*args))]
+    rank_sums, nnz_group, value_sums, ties = [np.concatenate(r, axis=0) for r in zip(*results)]
+    total = value_sums.sum(axis=1, keepdims=True)
+    total_nnz = nnz_group.sum(axis=1, keepdims=True)
+    rank_sums, nnz_group, value_sums = rank_sums[:, :n_groups], nnz_group[:, :n_groups], value_sums[:, :n_groups]
+
+    # z-scores of the rank sums (normal approximation, as in scanpy)
+    n = len(codes)
+    n_group = np.bincount(codes, minlength=n_groups + 1)[:n_groups].astype(np.float64)
+    n_rest = n - n_group
+    std = np.sqrt(n_group * n_rest * (n + 1) / 12.0)
+    if tie_correct:
+        std = std * np.sqrt(1 - ties / (n ** 3 - n))[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (rank_sums - n_group * (n + 1) / 2) / std
+    scores[np.isnan(scores)] = 0
+    pvals = 2 * norm.sf(np.abs(scores))
+
+    # Log fold changes from the group/rest means of the log data
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_group = value_sums / n_group
+        mean_rest = (total - value_sums) / n_rest
+    logfoldchanges = np.log2((np.expm1(mean_group) + 1e-9) / (np.expm1(mean_rest) + 1e-9))
+
+    # Per-group results, sorted by score
+    n_genes = adata.n_vars if n_genes is None else min(n_genes, adata.n_vars)
+    var_names = adata.var_names.values.astype(str)
+    fields = {"names": [], "scores": [], "logfoldchanges": [], "pvals": [], "pvals_adj": []}
+    for k in range(n_groups):
+        top = np.argsort(-scores[:, k], kind="stable")[:n_genes]
+        fields["names"].append(var_names[top])
+        fields["scores"].append(scores[top, k].astype(np.float32))
+        fields["logfoldchanges"].append(logfoldchanges[top, k].astype(np.float32))
+        fields["pvals"].append(pvals[top, k])
+        fields["pvals_adj"].append(_bh_adjust(pvals[:, k])[top])
+
+    result = {
+        "params": {
+            "groupby": groupby,
+            "reference": "rest",
+            "method": "wilcoxon",
+            "use_raw": False,
+            "layer": layer,
+            "corr_method": "benjamini-hochberg"
+        }
+    }
+    for key, arrays in fields.items():
+        result[key] = np.rec.fromarrays(arrays, names=[str(c) for c in categories])
+    if pts:
+        result["pts"] = pd.DataFrame(nnz_group / n_group, index=adata.var_names, columns=categories.astype(str))
+        result["pts_rest"] = pd.DataFrame(
+            (total_nnz - nnz_group) / n_rest,
+            index=adata.var_names,
+            columns=categories.astype(str)
         )
-        celltype_markers.to_csv(
-            csv_out,
-            index=False
+
+    adata.uns[key_added] = result
+
+
+# Function to build a reusable feature name mapping from a GTF table
+@profiled
+def build_feature_map(
+        gtf_info: pd.DataFrame,
+        from_col: str='GENEID',
+        to_col: str='GeneSymbol',
+        cache_path: Union[None, str]=None,
+        verbose: bool=True
+) -> pd.Series:
+    """
+    Function to build a feature name mapping (indexed by the names to map from) that can be reused across many
+    AnnData objects with `convert_feature_names`.
+    
+    Parameters:
+    -------
+    gtf_info    -- A DataFrame containing the mapping from one set of feature names to another. Can be None if `cache_path` already exists.
+    from_col    -- A string specifying the column in gtf_info to be mapped from. Default is 'GENEID'.
+    to_col      -- A string specifying the column in gtf_info to be mapped to. Default is 'GeneSymbol'.
+    cache_path  -- Path to a .npz file holding the mapping. If it exists, the mapping is loaded from it; otherwise it is written there after being built. Default is None (no caching).
+    verbose     -- A boolean specifying whether to print progress information. Default is True.
+
+    Returns:
+    -------
+    A pd.Series with the `from_col` names as its (unique) index and the `to_col` names as values.
+    """
+    import os
+
+    if cache_path is not None and os.path.isfile(cache_path):
+        if verbose: print(f"Loading feature map from {cache_path}")
+        with np.load(cache_path, allow_pickle=False) as npz:
+            return pd.Series(npz["to"], index=pd.Index(npz["from"], name=str(npz["from_col"])), name=str(npz["to_col"]))
+
+    if from_col not in gtf_info.columns:
+        raise ValueError(f"Column {from_col} not found in gtf_info")
+    if to_col not in gtf_info.columns:
+        raise ValueError(f"Column {to_col} not found in gtf_info")
+
+    # Later entries win for duplicated `from_col` names, as with dict(zip(...))
+    mapping = gtf_info[[from_col, to_col]].dropna().drop_duplicates(subset=from_col, keep="last")
+    feature_map = pd.Series(
+        mapping[to_col].astype(str).values,
+        index=pd.Index(mapping[from_col].astype(str).values, name=from_col),
+        name=to_col
+    )
+
+    if cache_path is not None:
+        np.savez(
+            cache_path,
+            **{"from": feature_map.index.values.astype(str), "to": feature_map.values.astype(str)},
+            from_col=from_col, to_col=to_col
         )
+        if verbose: print(f"Saved feature map to {cache_path}")
+
+    return feature_map
 
 
 # Function to convert feature names 
+@profiled
 def convert_feature_names(
-        adata: ad.AnnData,
-        gtf_info: pd.DataFrame, 
+        adata: Union[ad.AnnData, list],
+        gtf_info: Union[pd.DataFrame, pd.Series], 
         from_col: str='GENEID',
         to_col: str='GeneSymbol',
         inplace: bool=True,
@@ -195,47 +575,61 @@ def convert_feature_names(
     
     Parameters:
     -------
-    adata       -- An AnnData object which stores the gene expression data and metadata.
-    gtf_info    -- A DataFrame containing the mapping from one set of feature names to another.
+    adata       -- An AnnData object which stores the gene expression data and metadata, or a list of AnnData objects.
+    gtf_info    -- A DataFrame containing the mapping from one set of feature names to another, or a mapping built once with `build_feature_map`.
     from_col    -- A string specifying the column in gtf_info to be mapped from. Default is 'GENEID'.
     to_col      -- A string specifying the column in gtf_info to be mapped to. Default is 'GeneSymbol'.
     inplace     -- A boolean specifying whether to perform the conversion inplace or return a new AnnData object. Default is True.
     verbose     -- A boolean specifying whether to print progress information. Default is True.
 
+    Features without a match are removed (from both .var and the matrices), except for objects in backed mode,
+    where they keep their original names so that the on-disk matrix does not need to be rewritten.
+
     Returns:
     -------
-    If inplace is False, returns a new AnnData object with converted feature names.
+    If inplace is False, returns a new AnnData object (or a list of them) with converted feature names.
     """
 
-    if not inplace:
-        adata = adata.copy()
-
-    # Filter gtf_info to keep only the gene names found in the anndata object
-    if from_col not in gtf_info.columns:
-        raise ValueError(f"Column {from_col} not found in gtf_info")
+    if isinstance(gtf_info, pd.Series):
+        feature_map = gtf_info
+        from_col = feature_map.index.name if feature_map.index.name is not None else from_col
+        to_col = feature_map.name if feature_map.name is not None else to_col
     else:
-        gtf_info_filtered = gtf_info[gtf_info[from_col].isin(adata.var_names)]
-    
+        feature_map = build_feature_map(gtf_info, from_col=from_col, to_col=to_col, verbose=verbose)
+
+    if isinstance(adata, (list, tuple)):
+        out = [
+            convert_feature_names(a, feature_map, from_col=from_col, to_col=to_col, inplace=inplace, verbose=verbose)
+            for a in adata
+        ]
+        if not inplace:
+            return out
+        return None
+
+    # Vectorized lookup of every feature name in the mapping
+    idx = feature_map.index.get_indexer(adata.var_names)
+    found = idx >= 0
+
     if verbose:
-        num_found = len(gtf_info_filtered)
-        num_total = len(adata.var_names)
-        # fraction_found = num_found / num_total
-        print(f"Fraction of adata.var_names found in gtf_info[{from_col}]: {num_found} out of {num_total}")
-    
-    gene_name_mapping = dict(zip(
-        gtf_info[from_col], 
-        gtf_info[to_col]
-    ))
-    
-    adata.var[from_col] = adata.var_names
-    adata.var[to_col] = adata.var[from_col].map(gene_name_mapping)
+        print(f"Fraction of adata.var_names found in gtf_info[{from_col}]: {found.sum()} out of {len(found)}")
 
-    adata.var.dropna(subset=[to_col], inplace=True)
-    adata.var.reset_index(drop=True, inplace=True)
+    old_names = adata.var_names.values
+    new_names = np.where(found, feature_map.values[np.maximum(idx, 0)], old_names)
 
-    # mask = adata.var_names.isin(adata.var[to_col].values)
-    # adata = adata[:, mask].copy()
-    adata.var_names = adata.var[to_col]
+    if adata.isbacked:
+        if not inplace:
+            raise ValueError("inplace=False is not supported for AnnData objects in backed mode")
+        keep = np.ones(len(found), dtype=bool)
+    else:
+        keep = found
+        if not inplace:
+            adata = adata[:, keep].copy()
+        elif not keep.all():
+            adata._inplace_subset_var(keep)
+
+    adata.var[from_col] = old_names[keep]
+    adata.var[to_col] = new_names[keep]
+    adata.var_names = adata.var[to_col].astype(str).values
     adata.var_names_make_unique()
 
     if not inplace:
@@ -243,111 +637,262 @@ def convert_feature_names(
 
 
 # Remove cells with fewer than K neighbors within a distance D
-# def spatial_singlet_filter(
-#         adata: ad.AnnData,
-#         basis="spatial",
-#         D: int = 100, 
-#         K: int = 10
-#     ) -> ad.AnnData:
-#     """
-#     This function calculates the Euclidean distances between spatial coordinates, 
-#     finds the number of spatial neighbors within a given distance (D), and filters out cells 
-#     with fewer than a given number of neighbors (K).
-
-#     Parameters
-#     ----------
-#     adata: sc.AnnData
-#         An AnnData object. The function expects that this object contains spatial coordinates in adata.obsm['spatial'].
+@profiled
+def spatial_singlet_filter(
+        adata: ad.AnnData,
+        basis="spatial",
+        D: int = 100, 
+        K: int = 10,
+        store_graph: bool = False,
+        max_memory: float = 1024,
+        n_jobs: int = -1,
+        verbose: bool = True
+    ) -> ad.AnnData:
+    """
+    This function finds the number of spatial neighbors within a given distance (D) using a KD-tree radius query,
+    and filters out cells with K or fewer neighbors. Queries are processed in chunks of cells so that the working
+    memory stays bounded, and each chunk is spread across cores.
+
+    Parameters
+    ----------
+    adata: sc.AnnData
+        An AnnData object. The function expects that this object contains spatial coordinates in adata.obsm[basis].
+
+    basis: str, default="spatial"
+        Key in adata.obsm holding the spatial coordinates.
         
-#     D: int, default=100
-#         The maximum Euclidean distance to consider when determining spatial neighbors.
+    D: int, default=100
+        The maximum Euclidean distance to consider when determining spatial neighbors.
         
-#     K: int, default=10
-#         The minimum number of spatial neighbors required to keep a cell in the output AnnData object.
-
-#     Returns
-#     -------
-#     adata: ad.AnnData
-#         An updated AnnData object which only contains cells with more than K neighbors within a distance D. 
-#         Also, this object contains a new field in .obsm: "spatial_distances", which contains the Euclidean 
-#         distances between spatial coordinates, and a new field in .obs: "spatial_neighbors_{D}_true", which contains
-#         the number of spatial neighbors for each cell within a distance D.
-#     """
-#     import scipy.spatial as scisp
-#     import numpy as np
-#     import anndata as ad
-
-#     # Calculate Euclidean distances
-#     adata.obsm[f"{basis}_distances"] = scisp.distance.squareform(scisp.distance.pdist(adata.obsm[basis]))
-    
-#     # Calculate number of spatial neighbors within distance D for each cell
-#     adata.obs[f"{basis}_neighbors_{D}"] = np.sum(adata.obsm[f"{basis}_distances"] < D, axis=0)
+    K: int, default=10
+        Cells need more than K spatial neighbors (not counting themselves) to be kept in the output AnnData object.
+
+    store_graph: bool, default=False
+        If True, store the sparse radius graph (Euclidean distances between neighboring cells) in
+        adata.obsp[f"{basis}_distances_{D}"].
+
+    max_memory: float, default=1024
+        Approximate cap, in MB, on the working memory used for neighbor queries. Sets how many cells are
+        queried per chunk.
+
+    n_jobs: int, default=-1
+        Number of workers used for the tree queries. -1 uses all available cores.
+
+    verbose: bool, default=True
+        If True, print progress messages.
+
+    Returns
+    -------
+    adata: ad.AnnData
+        An updated AnnData object which only contains cells with more than K neighbors within a distance D. 
+        Also, this object contains a new field in .obs: "{basis}_neighbors_{D}", which contains the number of
+        spatial neighbors for each cell within a distance D, and (if store_graph=True) a new field in .obsp.
+    """
+    coords = np.asarray(adata.obsm[basis], dtype=np.float64)
+    num_cells = coords.shape[0]
+    tree = cKDTree(coords)
+
+    # Count neighbors in fixed-size chunks; only the integer counts are held in memory
+    max_bytes = max_memory * 1024**2
+    chunk_size = int(max(1, min(num_cells, max_bytes // (8 * coords.shape[1] + 8))))
+    n_neighbors = np.empty(num_cells, dtype=np.int64)
+    for start in range(0, num_cells, chunk_size):
+        stop = min(start + chunk_size, num_cells)
+        n_neighbors[start:stop] = tree.query_ball_point(
+            coords[start:stop], r=D, return_length=True, workers=n_jobs
+        ) - 1 # don't count the cell itself
+    adata.obs[f"{basis}_neighbors_{D}"] = n_neighbors
+
+    if verbose: print(f"Counted spatial neighbors within D={D} for {num_cells} cells")
+
+    if store_graph:
+        # Neighbor counts are known, so chunks can be cut to hold a fixed number of graph entries
+        # (index + distance per entry, plus the temporary Python lists from the ball query)
+        bytes_per_entry = 8 + 8 + 8 + 56
+        entry_offsets = np.concatenate([[0], np.cumsum(n_neighbors + 1)])
+        max_entries = max(1, int(max_bytes // bytes_per_entry))
+
+        blocks = []
+        start = 0
+        while start < num_cells:
+            stop = np.searchsorted(entry_offsets, entry_offsets[start] + max_entries, side='right') - 1
+            stop = min(max(stop, start + 1), num_cells)
+
+            hits = tree.query_ball_point(coords[start:stop], r=D, workers=n_jobs)
+            lengths = np.fromiter((len(h) for h in hits), dtype=np.int64, count=len(hits))
+            rows = np.repeat(np.arange(start, stop), lengths)
+            cols = np.fromiter((j for h in hits for j in h), dtype=np.int64, count=lengths.sum())
+            del hits
+
+            # Drop self-loops and store distances as graph weights
+            keep = rows != cols
+            rows, cols = rows[keep], cols[keep]
+            dists = np.linalg.norm(coords[rows] - coords[cols], axis=1)
+            blocks.append(sp.csr_matrix((dists, (rows - start, cols)), shape=(stop - start, num_cells)))
+            start = stop
+
+        adata.obsp[f"{basis}_distances_{D}"] = sp.vstack(blocks, format='csr')
+        if verbose: print(f"Stored radius graph in adata.obsp['{basis}_distances_{D}'] ({len(blocks)} chunks)")
     
-#     # Filter out cells with fewer than K spatial neighbors within distance D
-#     adata = adata[adata.obs[f"{basis}_neighbors_{D}"] > K,]
+    # Filter out cells with K or fewer spatial neighbors within distance D
+    adata = adata[adata.obs[f"{basis}_neighbors_{D}"] > K,]
+
+    if verbose: print(f"Kept {adata.n_obs} of {num_cells} cells with more than K={K} neighbors")
     
-#     return adata
+    return adata
 
 
 # Function to segment tissues based on spatial information
+@profiled
 def segment_tissues(adata, threshold='auto', num_tissues=None, inplace=True, verbose=True):
     """
     Segment tissues based on spatial information.
 
+    Cells are linked whenever they lie within `threshold` of each other (found with a KD-tree radius query), and
+    tissues are the connected components of the resulting sparse graph.
+
     Parameters:
         adata (Anndata): Annotated data object containing spatial coordinates.
-        threshold (float or str): Threshold distance for tissue segmentation. If 'auto', the threshold will be calculated based on the expected number of tissues.
+        threshold (float, str or list): Threshold distance for tissue segmentation. If 'auto', the threshold will be calculated based on the expected number of tissues.
+            A list of thresholds can be given to sweep several values in one call; the spatial index is built once and reused.
         num_tissues (int): Expected number of tissues. Required if threshold='auto'.
         inplace (bool): If True, the tissue labels will be added as adata.obs[f"segment_{threshold}"]. If False, the function will return a modified copy of the input Anndata object.
         verbose (bool): If True, print progress and summary messages.
 
     Returns:
-        Anndata: Annotated data object with tissue labels added as adata.obs[f"segment_{threshold}"].
+        Anndata: Annotated data object with tissue labels added as adata.obs[f"segment_{threshold}"] (one column per threshold).
 
     """
     if not inplace:
         adata = adata.copy()
 
-    spatial_coords = adata.obsm['spatial']
+    spatial_coords = np.asarray(adata.obsm['spatial'], dtype=np.float64)
     num_cells = len(spatial_coords)
 
-    # Calculate the average distance between cells
-    avg_distance = np.mean(np.linalg.norm(spatial_coords - np.mean(spatial_coords, axis=0), axis=1))
+    thresholds = list(threshold) if isinstance(threshold, (list, tuple, np.ndarray)) else [threshold]
 
-    # Calculate the threshold based on the expected number of tissues if 'auto' is selected
-    if threshold == 'auto':
+    if 'auto' in thresholds:
         if num_tissues is None:
             raise ValueError("num_tissues must be provided when threshold='auto'.")
-        threshold = num_tissues * avg_distance
-
-    tissue_labels = np.arange(num_cells)
-    for i in range(num_cells):
-        if verbose and i % (num_cells // 4) == 0:
-            print(f"Processing cell {i+1}/{num_cells}")
-
-        distances = np.linalg.norm(spatial_coords - spatial_coords[i], axis=1)
-        similar_cells = np.where(distances <= threshold)[0]
-        tissue_labels[similar_cells] = tissue_labels[i]
+        # Calculate the average distance between cells
+        avg_distance = np.mean(np.linalg.norm(spatial_coords - np.mean(spatial_coords, axis=0), axis=1))
+        # Calculate the threshold based on the expected number of tissues
+        thresholds = [num_tissues * avg_distance if t == 'auto' else t for t in thresholds]
+
+    # Build the spatial index once; it is shared by every threshold in the sweep
+    if verbose: print(f"Building KD-tree over {num_cells} cells...")
+    tree = cKDTree(spatial_coords)
+
+    for threshold in thresholds:
+        # All pairs of cells within `threshold` of each other
+        pairs = tree.query_pairs(r=threshold, output_type='ndarray')
+        if verbose: print(f"Found {len(pairs)} neighbor pairs within threshold={threshold}")
+
+        graph = sp.coo_matrix(
+            (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+            shape=(num_cells, num_cells)
+        )
+        n_components, tissue_codes = connected_components(graph, directed=False)
 
-    unique_labels, label_counts = np.unique(tissue_labels, return_counts=True)
-    label_mapping = {label: str(i) for i, label in enumerate(unique_labels)}
-    tissue_labels = pd.Categorical(tissue_labels.astype(str))
-    tissue_labels = tissue_labels.rename_categories(label_mapping)
-    adata.obs[f"segment_{threshold}"] = tissue_labels
+        adata.obs[f"segment_{threshold}"] = pd.Categorical.from_codes(
+            tissue_codes,
+            categories=[str(i) for i in range(n_components)]
+        )
 
-    if verbose:
-        unique_labels, label_counts = np.unique(tissue_labels, return_counts=True)
-        print(f"Segmentation completed using threshold={threshold}")
-        print(f"Number of identified tissues: {len(unique_labels)}")
-        print("Tissue labels summary:")
-        for label, count in zip(unique_labels, label_counts):
-            print(f"Tissue {label}: {count} cells")
+        if verbose:
+            label_counts = np.bincount(tissue_codes, minlength=n_components)
+            print(f"Segmentation completed using threshold={threshold}")
+            print(f"Number of identified tissues: {n_components}")
+            print("Tissue labels summary:")
+            for label, count in enumerate(label_counts):
+                print(f"Tissue {label}: {count} cells")
 
     if not inplace:
         return adata
 
 
+# Iterate over row blocks of a dense, scipy sparse, backed (h5ad) or dask matrix
+def _iter_row_blocks(X, chunk_size: int = 10000):
+    if isinstance(X, np.ndarray) or issparse(X):
+        # already in memory - a single block
+        yield 0, X.shape[0], X
+        return
+
+    is_dask = hasattr(X, "compute") and hasattr(X, "rechunk")
+    for start in range(0, X.shape[0], chunk_size):
+        stop = min(start + chunk_size, X.shape[0])
+        block = X[start:stop]
+        if is_dask:
+            block = block.compute()
+        yield start, stop, block
+
+
+# Chunked reductions that work the same on dense, scipy sparse, backed (h5ad) and dask matrices
+@profiled
+def chunked_reduce(
+    X,
+    op: str = "sum",
+    axis: Union[None, int] = None,
+    M = None,
+    chunk_size: int = 10000
+):
+    """
+    Reduce a matrix one block of rows at a time, so backed (e.g. `sc.read_h5ad(..., backed='r')`) and dask
+    matrices never need to be fully loaded.
+
+    Args:
+        X: Dense array, scipy sparse matrix, backed AnnData matrix (h5py dataset / sparse dataset) or dask array.
+        op (str, optional): "sum", "min", "max", or "matmul" (X @ M, e.g. per-gene-set sums with a gene x set indicator). Default is "sum".
+        axis (int, optional): 0 (per column), 1 (per row) or None (whole matrix), for "sum"/"min"/"max". Default is None.
+        M (optional): Dense or sparse matrix with X.shape[1] rows, for op="matmul".
+        chunk_size (int, optional): Number of rows read at a time for backed/dask matrices. Default is 10000.
+
+    Returns:
+        A flat np.ndarray (axis 0/1), a scalar (axis None), or a dense (n_rows x M.shape[1]) array for "matmul".
+    """
+    _dense = lambda m: m.toarray() if issparse(m) else np.asarray(m, dtype=np.float64)
+
+    if op == "matmul":
+        M = sp.csr_matrix(M)
+        out = np.empty((X.shape[0], M.shape[1]), dtype=np.float64)
+        for start, stop, block in _iter_row_blocks(X, chunk_size):
+            out[start:stop] = _dense(block @ M)
+        return out
+
+    if op not in ["sum", "min", "max"]:
+        raise ValueError(f"op must be 'sum', 'min', 'max' or 'matmul', not '{op}'")
+
+    if axis == 1:
+        out = np.empty(X.shape[0], dtype=np.float64)
+    partial = []
+    for start, stop, block in _iter_row_blocks(X, chunk_size):
+        if op == "sum":
+            res = block.sum(axis=axis)
+        elif issparse(block):
+            res = block.min(axis=axis) if op == "min" else block.max(axis=axis)
+            res = res.toarray() if issparse(res) else res
+        else:
+            res = np.min(block, axis=axis) if op == "min" else np.max(block, axis=axis)
+        res = np.asarray(res, dtype=np.float64).ravel()
+
+        if axis == 1:
+            out[start:stop] = res
+        else:
+            partial.append(res)
+
+    if axis == 1:
+        return out
+
+    partial = np.vstack(partial)
+    if op == "sum":
+        res = partial.sum(axis=0)
+    else:
+        res = partial.min(axis=0) if op == "min" else partial.max(axis=0)
+    return res if axis == 0 else float(res[0])
+
+
 # Function to add biotype % values to AnnData object
+@profiled
 def add_biotypes_pct(
     adata: ad.AnnData,
     biomart: Union[None, pd.DataFrame] = None, # DataFrame containing gene biotypes
@@ -356,10 +901,14 @@ def add_biotypes_pct(
     add_as: str = "obs", # how percent features should be added
     prefix: str = "pct.",
     scale: int = 100,
+    chunk_size: int = 10000,
     verbose: bool = True
 ) -> ad.AnnData:
     """
     This function adds gene biotype percentage values to an AnnData object.
+
+    A sparse gene x biotype indicator matrix is built once, and the counts for every biotype (plus the total counts)
+    are computed with a single product `X @ indicator`. Works on in-memory, backed and dask-backed matrices.
     
     Args:
         adata (AnnData): The AnnData object containing gene expression data.
@@ -367,8 +916,12 @@ def add_biotypes_pct(
         gene_colname (str, optional): Column name in biomart DataFrame for gene identifiers. Default is "GeneSymbol".
         biotype_colname (str, optional): Column name in biomart DataFrame for biotype. Default is "Biotype".
         add_as (str, optional): Determines how percent features should be added. Default is "obs".
+            "obs" adds one column per biotype with the percentage of each cell's counts from that biotype.
+            "var" adds each gene's biotype as `adata.var[biotype_colname]`, and the percentage of all counts in the
+            dataset coming from that biotype as `adata.var[prefix + biotype_colname]`.
         prefix (str, optional): Prefix for column names added to the AnnData object. Default is "pct.".
-        scale (int, optional): Determines the scaling for the percentage. Default is 100.
+        scale (int, optional): Determines the scaling for the percentage, 100 ([0,100]) or 1 ([0,1]). Default is 100.
+        chunk_size (int, optional): Number of cells read at a time for backed matrices. Default is 10000.
         verbose (bool, optional): Determines whether to print messages during function execution. Default is True.
         
     Returns:
@@ -379,74 +932,232 @@ def add_biotypes_pct(
         if verbose: print("Need a list of gene biotypes! Nothing done.")
         return adata
 
-    if add_as == "var":
-        if verbose: print("add_as='var' is not yet implemented")
+    if add_as not in ["obs", "var"]:
+        if verbose: print("`add_as` option not found... Try again.")
         return adata
 
-    if verbose: print(f"Adding gene biotype percentage values as {add_as} ...")
+    if scale not in [1, 100]:
+        if verbose: print("Given scale was not found. Scaling to 100...")
+        scale = 100
 
-    biotypes = biomart[biotype_colname].unique()
-
-    for biotype in biotypes:
-        # Subset out current gene biotype
-        tmp_mart = biomart[biomart[biotype_colname] == biotype]
+    if verbose: print(f"Adding gene biotype percentage values as {add_as} ...")
 
-        # Get unique gene names which are present in the adata object
-        tmp_feat = tmp_mart[gene_colname][tmp_mart[gene_colname].isin(adata.var_names)].unique()
+    # Unique (gene, biotype) pairs for genes present in the adata object
+    biotypes = pd.Index(biomart[biotype_colname].unique())
+    mart = biomart[[gene_colname, biotype_colname]].drop_duplicates()
+    gene_idx = adata.var_names.get_indexer(mart[gene_colname])
+    found = gene_idx >= 0
+    bt_idx = biotypes.get_indexer(mart[biotype_colname][found])
+    gene_idx = gene_idx[found]
 
-        if len(tmp_feat) == 0:
-            if verbose: print(f"  No {biotype} genes found...")
-        else:
-            if add_as == "obs":
-                col_name = prefix + biotype
-                
-                # Calculate the percentage
-                if issparse(adata.X):
-                    gene_pct = adata[:, tmp_feat].X.sum(axis=1) / adata.X.sum(axis=1)
-                else:
-                    gene_pct = adata[:, tmp_feat].X.sum(axis=1) / adata.X.sum(axis=1)
-                
-                # Add the percentage to the AnnData object
-                adata.obs[col_name] = np.asarray(gene_pct).flatten()
-                
-                # Scale the data if necessary
-                if scale == 1: # [0,1]
-                    adata.obs[col_name] /= 100
-                elif scale != 100: # [0,100]
-                    if verbose: print("Given scale was not found. Scaling to 100...")
-            else:
-                if verbose: print("`add_as` option not found... Try again.")
+    if verbose:
+        for biotype in biotypes[np.bincount(bt_idx, minlength=len(biotypes)) == 0]:
+            print(f"  No {biotype} genes found...")
+
+    # Gene x (biotypes + total) indicator matrix
+    indicator = sp.coo_matrix(
+        (
+            np.ones(len(gene_idx) + adata.n_vars),
+            (
+                np.concatenate([gene_idx, np.arange(adata.n_vars)]),
+                np.concatenate([bt_idx, np.full(adata.n_vars, len(biotypes))])
+            )
+        ),
+        shape=(adata.n_vars, len(biotypes) + 1)
+    ).tocsr()
+
+    biotype_counts = chunked_reduce(adata.X, "matmul", M=indicator, chunk_size=chunk_size)
+    totals = biotype_counts[:, -1]
+    biotype_counts = biotype_counts[:, :-1]
+    present = np.bincount(bt_idx, minlength=len(biotypes)) > 0
+
+    if add_as == "obs":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gene_pct = scale * biotype_counts[:, present] / totals[:, None]
+        adata.obs = pd.concat(
+            [
+                adata.obs.drop(columns=prefix + biotypes[present], errors="ignore"),
+                pd.DataFrame(gene_pct, index=adata.obs_names, columns=prefix + biotypes[present])
+            ],
+            axis=1
+        )
+    elif add_as == "var":
+        biotype_pct = scale * biotype_counts.sum(axis=0) / totals.sum()
+        gene_biotype = pd.Series(mart[biotype_colname][found].values, index=adata.var_names[gene_idx])
+        gene_biotype = gene_biotype[~gene_biotype.index.duplicated()].reindex(adata.var_names)
+        adata.var[biotype_colname] = gene_biotype.values
+        adata.var[prefix + biotype_colname] = gene_biotype.map(dict(zip(biotypes, biotype_pct))).values
 
     return adata
 
 
 # Function to label cells within a region of interest (ROI) polygon
-def label_roi_polygon(adata, roi_dict, metadata_col_name='roi', as_string=False):
+@profiled
+def label_roi_polygon(
+    adata, 
+    roi_dict, 
+    metadata_col_name='roi', 
+    as_string=False,
+    overlap='first',
+    as_matrix=False,
+    n_jobs=None
+):
     """
-    Add a column to adata.obs indicating whether each cell is within the defined region of interest (ROI) polygon.
+    Add a column to adata.obs indicating whether each cell is within the defined region of interest (ROI) polygon(s).
+
+    Several ROIs can be labeled in one call. Candidate spots are pre-filtered with each polygon's bounding box on the
+    raw coordinate array, and the point-in-polygon tests run in a thread pool (`Path.contains_points` releases the GIL).
 
     Parameters:
         adata (AnnData): Anndata object containing spatial coordinates in adata.obsm['spatial'].
-        roi_dict (dict): Dictionary containing the vertices of the ROI polygon.
+        roi_dict (dict or list): Dictionary containing the vertices of the ROI polygon.
                          Format: {'x': [x1, x2, x3, ...], 'y': [y1, y2, y3, ...]}
+                         For several ROIs, a dict of such dictionaries keyed by ROI name, or a list of them (named '0', '1', ...).
         metadata_col_name (str): Name of the new metadata column. Default is 'roi'.
         as_string (bool): If True, store the column values as strings ('True' or 'False').
                           If False, store the column values as booleans (True or False). Default is False.
+                          Only used for a single ROI.
+        overlap (str): For several ROIs, which label a spot inside more than one ROI gets: 'first' or 'last' (in the
+                       order given), or 'error' to raise. Spots outside every ROI are NaN. Default is 'first'.
+        as_matrix (bool): For several ROIs, also store a sparse spot x ROI membership matrix in
+                          adata.obsm[metadata_col_name] (ROI names in adata.uns[f"{metadata_col_name}_names"]). Default is False.
+        n_jobs (int): Number of threads. Default is None (Python's default for ThreadPoolExecutor).
 
     Returns:
         None
     """
-    roi_path = Path(list(zip(roi_dict['x'], roi_dict['y'])))
-    spatial_df = pd.DataFrame(adata.obsm['spatial'], columns=['x', 'y'])
-    roi_mask = roi_path.contains_points(spatial_df[['x', 'y']].values)
+    from concurrent.futures import ThreadPoolExecutor
+
+    if overlap not in ('first', 'last', 'error'):
+        raise ValueError(f"overlap must be 'first', 'last' or 'error', not '{overlap}'")
+
+    coords = np.asarray(adata.obsm['spatial'])[:, :2]
+
+    single = isinstance(roi_dict, dict) and 'x' in roi_dict and 'y' in roi_dict
+    if single:
+        rois = {metadata_col_name: roi_dict}
+    elif isinstance(roi_dict, dict):
+        rois = roi_dict
+    else:
+        rois = {str(i): roi for i, roi in enumerate(roi_dict)}
+    roi_names = list(rois.keys())
+
+    def _contains(roi):
+        verts = np.column_stack([roi['x'], roi['y']]).astype(np.float64)
+        lo = verts.min(axis=0)
+        hi = verts.max(axis=0)
+        # bounding box pre-filter on the raw coordinates
+        candidates = np.flatnonzero(np.all((coords >= lo) & (coords <= hi), axis=1))
+        inside = Path(verts).contains_points(coords[candidates])
+        return candidates[inside]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        hits = list(pool.map(_contains, rois.values()))
+
+    if single:
+        roi_mask = np.zeros(adata.n_obs, dtype=bool)
+        roi_mask[hits[0]] = True
+        if as_string:
+            roi_mask = pd.Series(roi_mask).map({True: 'True', False: 'False'}).values
+        adata.obs[metadata_col_name] = roi_mask
+        return None
+
+    # Spot x ROI membership
+    membership = sp.csr_matrix(
+        (
+            np.ones(sum(len(h) for h in hits), dtype=bool),
+            (np.concatenate(hits) if hits else np.array([], dtype=np.int64),
+             np.repeat(np.arange(len(hits)), [len(h) for h in hits]))
+        ),
+        shape=(adata.n_obs, len(roi_names))
+    )
+
+    n_hits = np.asarray(membership.sum(axis=1)).ravel()
+    if overlap == 'error' and np.any(n_hits > 1):
+        raise ValueError(f"{int(np.sum(n_hits > 1))} spots fall inside more than one ROI")
+
+    codes = np.full(adata.n_obs, -1, dtype=np.int64)
+    order = range(len(hits)) if overlap == 'last' else reversed(range(len(hits)))
+    for k in order: # later assignments win
+        codes[hits[k]] = k
+    adata.obs[metadata_col_name] = pd.Categorical.from_codes(codes, categories=[str(name) for name in roi_names])
+
+    if as_matrix:
+        adata.obsm[metadata_col_name] = membership
+        adata.uns[f"{metadata_col_name}_names"] = [str(name) for name in roi_names]
+
+
+# Function to save a sparse matrix as uncompressed component arrays, which `add_mtx_as_layer` can memory-map
+@profiled
+def save_mtx_components(
+    matrix,
+    out_dir: str
+):
+    """
+    Save a sparse matrix as uncompressed .npy component arrays (data, indices, indptr, shape) in a directory.
 
-    if as_string:
-        roi_mask = pd.Series(roi_mask).map({True: 'True', False: 'False'})
+    Args:
+        matrix: scipy sparse matrix (converted to CSR).
+        out_dir (str): Output directory (created if needed).
 
-    adata.obs[metadata_col_name] = roi_mask.values
+    Returns:
+        None
+    """
+    import os
+
+    matrix = sp.csr_matrix(matrix)
+    os.makedirs(out_dir, exist_ok=True)
+    for name, arr in [("data", matrix.data), ("indices", matrix.indices), ("indptr", matrix.indptr), ("shape", np.array(matrix.shape))]:
+        np.save(os.path.join(out_dir, f"{name}.npy"), arr)
+
+
+# Cells x genes layer from a genes x cells CSR matrix, without converting the whole (possibly memory-mapped) matrix
+# with .T.tocsr(): a first pass over chunks of stored rows counts the kept entries per cell, a second pass scatters
+# them straight into the output arrays (genes are visited in order, so column indices come out sorted)
+def _transposed_layer(matrix, cell_names, gene_names, obs_names, var_names, chunk_size):
+    # adata cell position for each matrix column, adata gene position for each matrix row (-1 = dropped)
+    row_idx = cell_names.get_indexer(obs_names)
+    cell_pos = np.full(len(cell_names), -1, dtype=np.int64)
+    cell_pos[row_idx[row_idx >= 0]] = np.flatnonzero(row_idx >= 0)
+    gene_pos = var_names.get_indexer(gene_names)
+    n_obs, n_vars = len(obs_names), len(var_names)
+
+    def _chunks():
+        start = 0
+        while start < matrix.shape[0]:
+            stop = int(np.searchsorted(matrix.indptr, matrix.indptr[start] + chunk_size, side='right')) - 1
+            stop = min(max(stop, start + 1), matrix.shape[0])
+            lo, hi = matrix.indptr[start], matrix.indptr[stop]
+            cell = cell_pos[np.asarray(matrix.indices[lo:hi])]
+            gene = np.repeat(gene_pos[start:stop], np.diff(matrix.indptr[start:stop + 1]))
+            keep = np.flatnonzero((cell >= 0) & (gene >= 0))
+            yield lo, cell[keep], gene[keep], keep
+            start = stop
+
+    counts = np.zeros(n_obs, dtype=np.int64)
+    for _, cell, _, _ in _chunks():
+        counts += np.bincount(cell, minlength=n_obs)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+
+    idx_dtype = np.int32 if max(n_vars, indptr[-1]) < 2**31 else np.int64
+    indices = np.empty(indptr[-1], dtype=idx_dtype)
+    data = np.empty(indptr[-1], dtype=matrix.dtype)
+    fill = indptr[:-1].copy()
+    for lo, cell, gene, keep in _chunks():
+        # stable grouping by cell keeps the gene order within each cell
+        order = np.argsort(cell, kind="stable")
+        cell = cell[order]
+        first = np.searchsorted(cell, cell)
+        dest = fill[cell] + np.arange(len(cell)) - first
+        indices[dest] = gene[order]
+        data[dest] = np.asarray(matrix.data[lo + keep[order]])
+        fill += np.bincount(cell, minlength=n_obs)
+
+    return sp.csr_matrix((data, indices, indptr), shape=(n_obs, n_vars))
 
 
 # Function to add a matrix as a new layer to an AnnData object
+@profiled
 def add_mtx_as_layer(
     adata: ad.AnnData,
     mtx_path: str,
@@ -455,66 +1166,1040 @@ def add_mtx_as_layer(
     layer_name: str,
     intersect: bool = False,
     inplace: bool = True,
+    transpose: bool = False,
+    mmap: bool = True,
+    chunk_size: int = 1 << 20,
 ):
     """
-    Read an mtx file and add it as a new layer to an AnnData object.
+    Read a sparse matrix and add it as a new layer to an AnnData object, aligned to adata.obs_names/var_names.
+
+    Rows and columns are matched to the AnnData object by name with hashed `get_indexer` lookups and the CSR matrix
+    is reordered once; cells or genes of the AnnData object missing from the matrix are filled with zeros, and
+    entries for names not in the AnnData object are dropped. adata.obs_names and adata.var_names are not changed.
 
     Args:
         adata (AnnData): AnnData object to which the matrix should be added as a new layer.
-        mtx_path (str): Path to the mtx file.
-        row_names (np.array): Array of row names in the mtx file.
-        col_names (np.array): Array of column names in the mtx file.
+        mtx_path (str): Path to a .npz file (scipy.sparse.save_npz), or a directory written by `save_mtx_components`
+            whose arrays can be memory-mapped instead of decompressed into RAM.
+        row_names (np.array): Array of row names in the matrix file (cell barcodes, or genes if transpose=True).
+        col_names (np.array): Array of column names in the matrix file (genes, or cell barcodes if transpose=True).
         layer_name (str): Name of the layer to be added.
         intersect (bool, optional): Whether to consider only the intersection of observations.
-            If False, the union of observations will be used. Default is False.
+            If True, cells missing from the matrix are removed from the AnnData object. If False, they are kept
+            with zeros in the new layer. Default is False.
         inplace (bool, optional): Whether to modify the input AnnData object in place or create a new copy.
             If True, modifications are made to the input AnnData object. If False, a new AnnData object is created
             with the added layer. Default is True.
+        transpose (bool, optional): Set to True if the matrix is genes x cells. The stored rows are then read in
+            chunks and only the entries kept in the layer are held in memory. Default is False.
+        mmap (bool, optional): Memory-map the component arrays when `mtx_path` is a directory. Default is True.
+        chunk_size (int, optional): Approximate number of stored entries read at a time when transpose=True.
+            Default is 2**20.
 
     Returns:
         None if inplace=True. Returns a new AnnData object with the added layer if inplace=False.
     """
-    if not inplace:
-        # Create a copy of the AnnData object
-        adata = adata.copy()
+    import os
 
     # Read the matrix file
-    matrix = sp.load_npz(mtx_path)
-
-    # Filter column names based on intersection or union with existing obs_names
-    existing_obs_names = adata.obs_names
-    if intersect:
-        col_names = np.intersect1d(col_names, existing_obs_names)
+    if os.path.isdir(mtx_path):
+        mode = 'r' if mmap else None
+        load = lambda name: np.load(os.path.join(mtx_path, f"{name}.npy"), mmap_mode=mode)
+        matrix = sp.csr_matrix(
+            (load("data"), load("indices"), load("indptr")),
+            shape=tuple(np.load(os.path.join(mtx_path, "shape.npy"))),
+            copy=False
+        )
     else:
-        col_names = np.union1d(col_names, existing_obs_names)
+        matrix = sp.load_npz(mtx_path)
 
-    # Find the column indices corresponding to col_names in the matrix
-    col_indices = np.where(np.isin(existing_obs_names, col_names))[0]
+    # Stays a view on the (possibly memory-mapped) arrays when the file already holds CSR
+    matrix = matrix.tocsr()
+    if transpose:
+        row_names, col_names = col_names, row_names
 
-    # Filter the matrix and column names based on the selected columns
-    matrix = matrix[:, col_indices]
-    col_names = existing_obs_names[col_indices]
+    row_names = pd.Index(np.asarray(row_names).astype(str))
+    col_names = pd.Index(np.asarray(col_names).astype(str))
 
-    # Create a new layer in the AnnData object
-    adata.layers[layer_name] = matrix
+    if intersect:
+        keep = adata.obs_names.isin(row_names)
+        if not inplace:
+            adata = adata[keep].copy()
+        elif not keep.all():
+            adata._inplace_subset_obs(keep)
+    elif not inplace:
+        # Create a copy of the AnnData object
+        adata = adata.copy()
+
+    if transpose:
+        layer = _transposed_layer(matrix, row_names, col_names, adata.obs_names, adata.var_names, chunk_size)
+    else:
+        # Matrix row for each cell of adata (-1 = missing -> zero-filled)
+        row_idx = row_names.get_indexer(adata.obs_names)
+        row_found = row_idx >= 0
+        lengths = np.where(row_found, np.diff(matrix.indptr)[np.maximum(row_idx, 0)], 0)
+
+        # Gather the rows once (contiguous slices of the - possibly memory-mapped - arrays)
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        starts = matrix.indptr[np.maximum(row_idx, 0)][row_found]
+        src = np.repeat(starts - indptr[:-1][row_found], lengths[row_found]) + np.arange(indptr[-1])
+        data = np.asarray(matrix.data[src])
+        indices = np.asarray(matrix.indices[src])
+
+        # adata gene position for each matrix column (-1 = not in adata -> dropped)
+        col_map = adata.var_names.get_indexer(col_names)
+        new_indices = col_map[indices]
+        keep = new_indices >= 0
+        kept_cum = np.concatenate([[0], np.cumsum(keep)])
+        indptr = kept_cum[indptr]
+
+        layer = sp.csr_matrix(
+            (data[keep], new_indices[keep], indptr),
+            shape=(adata.n_obs, adata.n_vars)
+        )
+    layer.sort_indices()
 
-    # Assign row and column names to the AnnData object
-    adata.var_names = col_names
-    adata.obs_names = row_names
+    # Create a new layer in the AnnData object
+    adata.layers[layer_name] = layer
 
     if not inplace:
         return adata
 
-def top_n_genes(adata, n):
+
+# Function to concatenate AnnData objects on disk, one sample at a time
+@profiled
+def concatenate_to_h5ad(
+    adatas: list,
+    out_path: str,
+    batch_key: str = "batch",
+    batch_categories: Union[None, list] = None,
+    index_unique: Union[None, str] = "-",
+    dtype = np.float32,
+    compression: Union[None, str] = None,
+    backed: Union[None, str] = None,
+    verbose: bool = True
+):
+    """
+    Concatenate AnnData objects (or .h5ad files) along obs by streaming their count matrices into an .h5ad file.
+
+    The output uses the union of all feature names (in order of first appearance). Each sample's matrix is
+    converted to CSR, re-indexed into the union feature space and appended to the on-disk `X`, so the merged matrix
+    is never held in memory. When paths are given, only one sample is loaded at a time.
+
+    Args:
+        adatas (list): List of AnnData objects and/or paths to .h5ad files.
+        out_path (str): Path to the output .h5ad file (overwritten if it exists).
+        batch_key (str, optional): Name of the obs column recording which input each cell came from. Default is "batch".
+        batch_categories (list, optional): Labels for each input in `batch_key`. Default is '0', '1', ...
+        index_unique (str, optional): Cell names become "<barcode><index_unique><batch>" so that barcodes shared between samples stay unique. If None, barcodes are kept as they are (a warning is raised if they are then not unique). Default is "-".
+        dtype (optional): Data type of the stored matrix. Default is np.float32.
+        compression (str, optional): h5py compression for the matrix datasets (e.g. "gzip"). Default is None.
+        backed (str, optional): If 'r' or 'r+', return the merged object opened in backed mode. Default is None.
+        verbose (bool, optional): Whether to print progress information. Default is True.
+
+    Returns:
+        None, or the merged AnnData object opened in backed mode if `backed` is given.
+    """
+    import h5py
+
+    if batch_categories is None:
+        batch_categories = [str(i) for i in range(len(adatas))]
+
+    def _get(x, backed_mode=None):
+        return ad.read_h5ad(x, backed=backed_mode) if isinstance(x, str) else x
+
+    # First pass: union feature space and merged obs/var (metadata only)
+    var_names = pd.Index([])
+    var = pd.DataFrame()
+    obs_list = []
+    for i, x in enumerate(adatas):
+        tmp = _get(x, backed_mode='r')
+        new_vars = tmp.var_names[~tmp.var_names.isin(var_names)]
+        var_names = var_names.append(new_vars)
+        var = pd.concat([var, tmp.var.loc[new_vars]])
+
+        obs = tmp.obs.copy()
+        obs[batch_key] = batch_categories[i]
+        if index_unique is not None:
+            obs.index = obs.index.astype(str) + index_unique + str(batch_categories[i])
+        obs_list.append(obs)
+        if isinstance(x, str): tmp.file.close()
+
+    obs = pd.concat(obs_list)
+    obs[batch_key] = pd.Categorical(obs[batch_key], categories=batch_categories)
+    if not obs.index.is_unique:
+        warnings.warn(
+            f"{int(obs.index.duplicated().sum())} cell names occur in more than one input; "
+            "set `index_unique` to make them unique"
+        )
+    var.index = var_names
+
+    # Write obs/var without X, then stream the matrix into the file
+    ad.AnnData(obs=obs, var=var).write_h5ad(out_path)
+
+    n_obs, n_vars = len(obs), len(var_names)
+    with h5py.File(out_path, "a") as f:
+        if "X" in f: del f["X"]
+        X = f.create_group("X")
+        X.attrs["encoding-type"] = "csr_matrix"
+        X.attrs["encoding-version"] = "0.1.0"
+        X.attrs["shape"] = (n_obs, n_vars)
+        data = X.create_dataset("data", shape=(0,), maxshape=(None,), dtype=dtype, chunks=(2**16,), compression=compression)
+        indices = X.create_dataset("indices", shape=(0,), maxshape=(None,), dtype=np.int32 if n_vars < 2**31 else np.int64, chunks=(2**16,), compression=compression)
+        indptr = X.create_dataset("indptr", shape=(1,), maxshape=(None,), dtype=np.int64, data=np.zeros(1))
+
+        nnz = 0
+        for i, x in enumerate(adatas):
+            tmp = _get(x)
+            mtx = sp.csr_matrix(tmp.X)
+
+            # Map this sample's feature indices into the union feature space
+            col_map = var_names.get_indexer(tmp.var_names)
+            block = sp.csr_matrix(
+                (mtx.data.astype(dtype, copy=False), col_map[mtx.indices], mtx.indptr),
+                shape=(mtx.shape[0], n_vars)
+            )
+            block.sort_indices()
+
+            data.resize((nnz + block.nnz,))
+            data[nnz:] = block.data
+            indices.resize((nnz + block.nnz,))
+            indices[nnz:] = block.indices
+            n_ptr = indptr.shape[0]
+            indptr.resize((n_ptr + block.shape[0],))
+            indptr[n_ptr:] = block.indptr[1:] + nnz
+            nnz += block.nnz
+
+            if verbose: print(f"  Appended {batch_categories[i]}: {block.shape[0]} cells, {block.nnz} non-zero entries")
+            del tmp, mtx, block
+
+    if verbose: print(f"Wrote {n_obs} cells and {n_vars} genes to {out_path}")
+
+    if backed is not None:
+        return ad.read_h5ad(out_path, backed=backed)
+
+
+@profiled
+def top_n_genes(
+        adata, 
+        n, 
+        layer=None, 
+        groupby=None,
+        chunk_size=10000
+    ):
     """
     Identify the top N genes with the highest sum of expression values in an AnnData object.
 
     Parameters:
     adata (AnnData): An AnnData object storing the gene expression data and metadata.
-    n (int): The number of top genes to return.
+    n (int): The number of top genes to return. An empty list is returned for n <= 0.
+    layer (str): Layer to sum instead of adata.X (e.g. raw counts). Default is None (adata.X).
+    groupby (str): Categorical obs column. If given, the top genes are found separately for each group, with the
+        per-group sums computed in one sparse group-indicator matrix product. Default is None.
+    chunk_size (int): Number of cells read at a time for backed/dask matrices. Default is 10000.
+
+    Returns:
+    list: A list of top N genes sorted by their sum of expression values, or a dict of such lists (one per group) if `groupby` is given.
+    """
+    X = adata.X if layer is None else adata.layers[layer]
+    n = min(n, adata.n_vars)
+
+    def _top(sums):
+        if n <= 0:
+            return []
+        # O(G) partial selection, then sort only the selected genes
+        top = np.argpartition(sums, -n)[-n:] if n < len(sums) else np.arange(len(sums))
+        top = top[np.argsort(sums[top], kind="stable")[::-1]]
+        return adata.var_names[top].tolist()
+
+    if groupby is None:
+        return _top(chunked_reduce(X, "sum", axis=0, chunk_size=chunk_size))
+
+    # Group x cell indicator matrix
+    groups = adata.obs[groupby].astype("category")
+    codes = groups.cat.codes.values
+    valid = codes >= 0
+    indicator = sp.csr_matrix(
+        (np.ones(valid.sum()), (codes[valid], np.flatnonzero(valid))),
+        shape=(len(groups.cat.categories), adata.n_obs)
+    )
+
+    group_sums = np.zeros((indicator.shape[0], adata.n_vars))
+    for start, stop, block in _iter_row_blocks(X, chunk_size):
+        res = indicator[:, start:stop] @ block
+        group_sums += res.toarray() if issparse(res) else np.asarray(res)
+
+    return {
+        group: _top(group_sums[k])
+        for k, group in enumerate(groups.cat.categories)
+    }
+
+
+# Score many marker panels at once (batched equivalent of sc.tl.score_genes)
+@profiled
+def score_gene_panels(
+    adata,
+    gene_sets,
+    ctrl_size: int = 50,
+    n_bins: int = 25,
+    layer=None,
+    score_suffix: str = "_score",
+    obsm_key=None,
+    random_state: int = 0,
+    chunk_size: int = 10000,
+    verbose: bool = True
+):
+    """
+    Score every marker panel in `gene_sets` the way sc.tl.score_genes does (mean of the panel genes minus the mean of
+    expression-matched control genes), but with one pass over the matrix for all panels.
+
+    Genes are binned by mean expression once, control genes are drawn for every panel from those bins, and all scores
+    come out of a single sparse product X @ W, where W (genes x panels) holds +1/n_panel for panel genes and
+    -1/n_control for control genes. Backed/dask matrices are read in row blocks of `chunk_size`.
+
+    Args:
+        adata (AnnData): The AnnData object (may be backed).
+        gene_sets (dict or str): Dictionary of panel name -> list of genes, or a .csv of gene lists (one per column, as read by read_csv_to_dict).
+        ctrl_size (int, optional): Number of control genes drawn per expression bin. Default is 50.
+        n_bins (int, optional): Number of expression bins. Default is 25.
+        layer (str, optional): Layer to score instead of adata.X. Default is None.
+        score_suffix (str, optional): Suffix added to panel names for the .obs columns. Default is "_score".
+        obsm_key (str, optional): If given, store all scores as one DataFrame in adata.obsm[obsm_key] instead of .obs columns. Default is None.
+        random_state (int, optional): Seed for the control-gene draws. Each panel gets its own stream, so scores do not depend on panel order. Default is 0.
+        chunk_size (int, optional): Number of cells read at a time for backed/dask matrices. Default is 10000.
+        verbose (bool, optional): Print progress. Default is True.
+
+    Returns:
+        pd.DataFrame of scores (cells x panels). Scores are also added to `adata` in place.
+    """
+    import zlib
+    from scipy.stats import rankdata
+
+    X = adata.X if layer is None else adata.layers[layer]
+
+    # Panel genes as positions in var_names
+    if isinstance(gene_sets, str):
+        _, panel_idx = read_csv_to_dict(gene_sets, names2check=adata.var_names, return_indices=True)
+    else:
+        panel_idx = {
+            name: (lambda pos: pos[pos >= 0])(adata.var_names.get_indexer(pd.Index(genes).unique()))
+            for name, genes in gene_sets.items()
+        }
+    panel_idx = {name: np.unique(idx) for name, idx in panel_idx.items()}
+    for name in [name for name, idx in panel_idx.items() if len(idx) == 0]:
+        if verbose:
+            print(f"No genes of panel '{name}' were found in adata.var_names, skipping...")
+        del panel_idx[name]
+    names = list(panel_idx.keys())
+
+    # Expression bins, computed once (same cut as scanpy)
+    gene_means = chunked_reduce(X, "sum", axis=0, chunk_size=chunk_size) / adata.n_obs
+    n_items = int(np.round(len(gene_means) / (n_bins - 1)))
+    gene_bins = (rankdata(gene_means, method="min") // n_items).astype(np.int64)
+    order = np.argsort(gene_bins, kind="stable")
+    bin_starts = np.searchsorted(gene_bins[order], np.arange(gene_bins.max() + 2))
+
+    # Draw control genes for all panels and build the gene x panel weight matrix
+    rows, cols, vals = [], [], []
+    for k, name in enumerate(names):
+        rng = np.random.default_rng([random_state, zlib.crc32(str(name).encode())])
+        genes = panel_idx[name]
+        ctrl = []
+        for b in np.unique(gene_bins[genes]):
+            members = order[bin_starts[b]:bin_starts[b + 1]]
+            ctrl.append(rng.choice(members, ctrl_size, replace=False) if ctrl_size < len(members) else members)
+        ctrl = np.setdiff1d(np.concatenate(ctrl), genes)
+
+        rows += [genes, ctrl]
+        cols += [np.full(len(genes), k), np.full(len(ctrl), k)]
+        vals += [np.full(len(genes), 1 / len(genes)), np.full(len(ctrl), -1 / max(len(ctrl), 1))]
+    W = sp.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(adata.n_vars, len(names))
+    )
+
+    if verbose:
+        print(f"Scoring {len(names)} panels...")
+    scores = pd.DataFrame(
+        chunked_reduce(X, "matmul", M=W, chunk_size=chunk_size),
+        index=adata.obs_names,
+        columns=names
+    )
+
+    if obsm_key is not None:
+        adata.obsm[obsm_key] = scores
+    else:
+        for name in names:
+            adata.obs[f"{name}{score_suffix}"] = scores[name].values
+
+    return scores
+
+
+# Regress out obs covariates (e.g. cell-cycle scores) from every gene with a single least-squares fit
+@profiled
+def regress_out(
+    adata,
+    keys,
+    layer=None,
+    use_highly_variable: bool = False,
+    chunk_size: int = 10000,
+    n_jobs=None,
+    inplace: bool = True
+):
+    """
+    Faster replacement for sc.pp.regress_out. Instead of one GLM per gene, the design matrix [1, covariates] is
+    decomposed once (thin SVD, i.e. a pseudo-inverse, so collinear covariates are fine), and the residuals
+    X - U (U^T X) are computed for all genes at once, one block of cells at a time. Categorical keys are one-hot
+    encoded. The result equals sc.pp.regress_out's, so e.g. the 'pca_cc' embedding can be computed as before.
+
+    Args:
+        adata (AnnData): The AnnData object (in memory).
+        keys (str or list): Numerical or categorical obs columns to regress out, e.g. ['S_score', 'G2M_score'].
+        layer (str, optional): Layer to correct instead of adata.X. Default is None.
+        use_highly_variable (bool, optional): Only correct the genes in adata.var['highly_variable'] (enough for a PCA on HVGs); other genes are left unchanged. Default is False.
+        chunk_size (int, optional): Number of cells processed at a time. Default is 10000.
+        n_jobs (int, optional): Number of threads working on blocks of cells. Default is None (Python's default for ThreadPoolExecutor).
+        inplace (bool, optional): Modify `adata` in place; otherwise return a corrected copy. Default is True.
+
+    Returns:
+        None, or the corrected AnnData if inplace=False.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not inplace:
+        adata = adata.copy()
+    keys = [keys] if isinstance(keys, str) else list(keys)
+
+    # Design matrix: intercept + numerical covariates + one-hot categorical covariates
+    design = [np.ones((adata.n_obs, 1))]
+    for key in keys:
+        col = adata.obs[key]
+        if isinstance(col.dtype, pd.CategoricalDtype) or col.dtype == object:
+            design.append(pd.get_dummies(col, drop_first=True, dtype=np.float64).values)
+        else:
+            design.append(col.values.astype(np.float64)[:, None])
+    design = np.hstack(design)
+
+    # Orthonormal basis of the design's column space
+    U, s, _ = np.linalg.svd(design, full_matrices=False)
+    U = U[:, s > s[0] * max(design.shape) * np.finfo(np.float64).eps]
+
+    X = adata.X if layer is None else adata.layers[layer]
+    if issparse(X):
+        X = X.toarray() # residuals are dense
+    if not np.issubdtype(X.dtype, np.floating):
+        X = X.astype(np.float32)
+    genes = np.flatnonzero(adata.var["highly_variable"].values) if use_highly_variable else slice(None)
+
+    blocks = [(start, min(start + chunk_size, adata.n_obs)) for start in range(0, adata.n_obs, chunk_size)]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        # Coefficients on the orthonormal basis, U^T X
+        coef = sum(pool.map(lambda b: U[b[0]:b[1]].T @ X[b[0]:b[1], genes], blocks))
+
+        def _residualize(b):
+            X[b[0]:b[1], genes] = X[b[0]:b[1], genes] - (U[b[0]:b[1]] @ coef).astype(X.dtype)
+
+        list(pool.map(_residualize, blocks))
+
+    if layer is None:
+        adata.X = X
+    else:
+        adata.layers[layer] = X
+
+    if not inplace:
+        return adata
+
+
+# Pseudobulk aggregation over any combination of obs keys (e.g. sample x cell type)
+@profiled
+def pseudobulk(
+    adata,
+    groupby,
+    layer=None,
+    fraction: bool = True,
+    min_cells: int = 0,
+    carry_obs: bool = True,
+    chunk_size: int = 10000,
+    n_jobs=None,
+    verbose: bool = True
+):
+    """
+    Aggregate cells into pseudobulk profiles for every observed combination of the `groupby` obs columns.
+
+    Each combination gets a group code, and per-group sums and numbers of expressing cells come from a
+    (groups x cells) sparse indicator matrix multiplied with blocks of cells. Blocks are processed in parallel threads
+    and backed/dask matrices are read one block at a time.
+
+    Args:
+        adata (AnnData): The AnnData object (may be backed).
+        groupby (str or list): obs column(s) to group by, e.g. ['sample', 'celltype'].
+        layer (str, optional): Layer to aggregate instead of adata.X (e.g. raw counts). Default is None.
+        fraction (bool, optional): Also compute the fraction of cells expressing each gene. Default is True.
+        min_cells (int, optional): Drop groups with fewer cells. Default is 0.
+        carry_obs (bool, optional): Copy over other obs columns that are constant within every group (e.g. 'timepoint' when grouping by 'sample'). Default is True.
+        chunk_size (int, optional): Number of cells per block. Default is 10000.
+        n_jobs (int, optional): Number of threads. Default is None (Python's default for ThreadPoolExecutor).
+        verbose (bool, optional): Print progress. Default is True.
 
     Returns:
-    list: A list of top N genes sorted by their sum of expression values.
+        AnnData (groups x genes) with the summed expression in .X, and layers 'mean' and 'fraction'. obs holds the
+        `groupby` columns, 'n_cells', and any carried-over columns.
     """
-    sorted_genes = adata.var_names[np.argsort(adata.X.sum(axis=0))[::-1]]
-    return sorted_genes[:n].tolist()
\ No newline at end of file
+    from concurrent.futures import ThreadPoolExecutor
+
+    groupby = [groupby] if isinstance(groupby, str) else list(groupby)
+    X = adata.X if layer is None else adata.layers[layer]
+
+    # Group codes for the observed combinations of keys
+    obs = adata.obs[groupby]
+    codes = obs.groupby(groupby, observed=True, sort=True).ngroup().fillna(-1).values.astype(np.int64)
+    valid = codes >= 0 # cells with a missing key are left out
+    n_groups = int(codes.max()) + 1 if valid.any() else 0
+    indicator = sp.csr_matrix(
+        (np.ones(valid.sum()), (codes[valid], np.flatnonzero(valid))),
+        shape=(n_groups, adata.n_obs)
+    )
+    if verbose:
+        print(f"Aggregating {valid.sum()} cells into {n_groups} groups...")
+
+    _dense = lambda m: m.toarray() if issparse(m) else np.asarray(m, dtype=np.float64)
+    is_dask = hasattr(X, "compute") and hasattr(X, "rechunk")
+
+    def _aggregate(bounds):
+        start, stop = bounds
+        block = X[start:stop]
+        block = block.compute() if is_dask else block
+        ind = indicator[:, start:stop]
+        sums = _dense(ind @ block)
+        if not fraction:
+            return sums, None
+        expressed = (block != 0).astype(np.float64) if issparse(block) else sp.csr_matrix(np.asarray(block) != 0, dtype=np.float64)
+        return sums, _dense(ind @ expressed)
+
+    blocks = [(start, min(start + chunk_size, adata.n_obs)) for start in range(0, adata.n_obs, chunk_size)]
+    sums = np.zeros((n_groups, adata.n_vars))
+    n_expr = np.zeros((n_groups, adata.n_vars)) if fraction else None
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for block_sums, block_expr in pool.map(_aggregate, blocks):
+            sums += block_sums
+            if fraction:
+                n_expr += block_expr
+
+    # obs of the pseudobulk object: one row per group
+    n_cells = np.bincount(codes[valid], minlength=n_groups)
+    first = np.unique(codes[valid], return_index=True)[1]
+    group_obs = obs.iloc[np.flatnonzero(valid)[first]].reset_index(drop=True)
+    if carry_obs:
+        other = [c for c in adata.obs.columns if c not in groupby]
+        if len(other) > 0:
+            constant = adata.obs.loc[valid, other].groupby(codes[valid], observed=True).nunique(dropna=False).max(axis=0) <= 1
+            for col in constant.index[constant.values]:
+                group_obs[col] = adata.obs[col].iloc[np.flatnonzero(valid)[first]].values
+    group_obs["n_cells"] = n_cells
+    group_obs.index = ["_".join(map(str, row)) for row in obs.iloc[np.flatnonzero(valid)[first]].itertuples(index=False)]
+
+    pb = ad.AnnData(
+        X=sp.csr_matrix(sums),
+        obs=group_obs,
+        var=adata.var.copy()
+    )
+    pb.layers["mean"] = sp.csr_matrix(sums / np.maximum(n_cells, 1)[:, None])
+    if fraction:
+        pb.layers["fraction"] = sp.csr_matrix(n_expr / np.maximum(n_cells, 1)[:, None])
+
+    if min_cells > 0:
+        pb = pb[pb.obs["n_cells"] >= min_cells].copy()
+
+    return pb
+
+
+# Paths of the matrix/features/barcodes files in a 10x-style directory; falls back to uncompressed files (STARsolo's default)
+def _mtx_files(mtx_dir: str) -> list:
+    import os
+
+    out = []
+    for candidates in [["matrix.mtx.gz", "matrix.mtx"], ["features.tsv.gz", "features.tsv", "genes.tsv"], ["barcodes.tsv.gz", "barcodes.tsv"]]:
+        paths = [os.path.join(mtx_dir, f) for f in candidates]
+        out.append(next((f for f in paths if os.path.isfile(f)), paths[0]))
+    return out
+
+
+# Helper to load a single sample (row of the metadata table); module-level so it can be sent to worker processes
+def _load_sample(
+    sample: str,
+    data_dir: str,
+    soupx: bool,
+    soupx_subdir: str,
+    filtered_subdir: str,
+    cache_dir: Union[None, str]
+) -> ad.AnnData:
+    import hashlib
+    import os
+
+    if soupx:
+        # Scrubbed matrices from soupx don't have features saved in 10x format, need manual loading
+        mtx_dir = os.path.join(data_dir, soupx_subdir)
+    else:
+        mtx_dir = os.path.join(data_dir, filtered_subdir)
+    src_files = _mtx_files(mtx_dir)
+
+    # Cache key: source paths + modification times, so edited/re-run outputs invalidate the cache
+    cache_path = None
+    if cache_dir is not None:
+        key = "|".join(f"{os.path.abspath(f)}:{os.stat(f).st_mtime_ns}" for f in src_files)
+        key = hashlib.sha1(key.encode()).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, f"{sample}_{key}.h5ad")
+        if os.path.isfile(cache_path):
+            return ad.read_h5ad(cache_path)
+
+    if soupx:
+        adata = sc.read_mtx(filename=src_files[0]).transpose()
+        adata.var_names = pd.read_csv(src_files[1], header=None, sep="\t").iloc[:, 0].astype(str).values
+        adata.obs_names = pd.read_csv(src_files[2], header=None, sep="\t").iloc[:, 0].astype(str).values
+        adata.X = sp.csr_matrix(adata.X)
+    elif not all(f.endswith(".gz") for f in src_files):
+        # Uncompressed output (sc.read_10x_mtx only reads these in the legacy genes.tsv layout)
+        adata = sc.read_mtx(filename=src_files[0]).transpose()
+        features = pd.read_csv(src_files[1], header=None, sep="\t").astype(str)
+        adata.var_names = ad.utils.make_index_unique(pd.Index(features.iloc[:, min(1, features.shape[1] - 1)].values))
+        adata.var["gene_ids"] = features.iloc[:, 0].values
+        if features.shape[1] > 2:
+            adata.var["feature_types"] = features.iloc[:, 2].values
+            adata = adata[:, adata.var["feature_types"] == "Gene Expression"].copy()
+        adata.obs_names = pd.read_csv(src_files[2], header=None, sep="\t").iloc[:, 0].astype(str).values
+        adata.X = sp.csr_matrix(adata.X)
+    else:
+        adata = sc.read_10x_mtx(
+            path=mtx_dir,
+            var_names='gene_symbols',
+            make_unique=True,
+            cache=False
+        )
+    adata.var_names_make_unique()
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        adata.write_h5ad(cache_path)
+
+    return adata
+
+
+# Function to load every sample listed in a metadata table (e.g. resources/metadata.csv)
+@profiled
+def load_samples(
+    meta: pd.DataFrame,
+    sample_col: str = "sample",
+    dir_col: str = "data.dir",
+    soupx_col: str = "soupx",
+    soupx_subdir: str = "Solo.out/GeneFull/soupx",
+    filtered_subdir: str = "Solo.out/GeneFull/filtered",
+    cache_dir: Union[None, str] = None,
+    counts_layer: Union[None, str] = "counts",
+    n_jobs: int = None,
+    verbose: bool = True
+) -> list:
+    """
+    Load all included samples from a metadata table in parallel, and add the sample metadata to .obs.
+
+    Parameters:
+    -------
+    meta            -- A DataFrame with one row per sample (e.g. read from resources/metadata.csv). If it has an 'include' column, only rows where it is True are loaded.
+    sample_col      -- Column holding the sample names. Default is 'sample'.
+    dir_col         -- Column holding each sample's STARsolo output directory. Default is 'data.dir'.
+    soupx_col       -- Column flagging samples whose SoupX-corrected matrix should be loaded. Default is 'soupx'.
+    soupx_subdir    -- Sub-directory (relative to `dir_col`) of the SoupX matrix/features/barcodes. Default is 'Solo.out/GeneFull/soupx'.
+    filtered_subdir -- Sub-directory (relative to `dir_col`) of the filtered 10x matrix. Default is 'Solo.out/GeneFull/filtered'.
+    cache_dir       -- Directory for binary (.h5ad) caches of the parsed matrices, keyed on source path + mtime. If None, no cache is used. Default is None.
+    counts_layer    -- If not None, save the raw counts as a layer with this name. Default is 'counts'.
+    n_jobs          -- Number of worker processes. If None, uses one per sample (up to the number of cores). Default is None.
+    verbose         -- A boolean specifying whether to print progress information. Default is True.
+
+    Returns:
+    -------
+    adata_list -- A list of AnnData objects, in the same order as the included rows of `meta`.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+
+    if "include" in meta.columns:
+        meta = meta.loc[meta["include"].astype(str).str.upper() == "TRUE"]
+    meta = meta.reset_index(drop=True)
+
+    soupx = (meta[soupx_col].astype(str).str.upper() == "TRUE").values
+    if n_jobs is None:
+        n_jobs = min(len(meta), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        futures = [
+            pool.submit(
+                worker_call, _load_sample,
+                meta[sample_col][i], meta[dir_col][i], soupx[i],
+                soupx_subdir, filtered_subdir, cache_dir
+            )
+            for i in range(meta.shape[0])
+        ]
+        adata_list = [collect_worker_records(f.result()) for f in futures]
+
+    for i, adata in enumerate(adata_list):
+        if counts_layer is not None:
+            adata.layers[counts_layer] = adata.X # save counts as a layer for future plotting
+
+        # Add all metadata columns at once, as constant categorical columns
+        sample_meta = pd.DataFrame(
+            {
+                col: pd.Categorical.from_codes(
+                    np.zeros(adata.n_obs, dtype=np.int8),
+                    categories=[meta[col][i]]
+                ) if not pd.isna(meta[col][i]) else np.full(adata.n_obs, np.nan)
+                for col in meta.columns
+            },
+            index=adata.obs_names
+        )
+        adata.obs = pd.concat([adata.obs.drop(columns=meta.columns, errors="ignore"), sample_meta], axis=1)
+
+        if verbose: print(f"{meta[sample_col][i]}: loaded {adata.n_obs} cells and {adata.n_vars} genes...")
+
+    return adata_list
+
+
+# Stream per-barcode UMI totals from a raw count matrix without building an AnnData object
+def _stream_barcode_totals(
+    path: str,
+    chunk_size: int = 10_000_000
+) -> np.ndarray:
+    import gzip
+    import os
+
+    if os.path.isdir(path):
+        path = _mtx_files(path)[0]
+
+    if path.endswith(".h5"):
+        # 10x/STARsolo .h5: CSC matrix, one column per barcode
+        import h5py
+        with h5py.File(path, "r") as f:
+            grp = f["matrix"]
+            indptr = grp["indptr"][:]
+            data = grp["data"]
+            n_bc = len(indptr) - 1
+            totals = np.zeros(n_bc, dtype=np.float64)
+            # blocks of barcodes holding at most ~chunk_size entries
+            b0 = 0
+            while b0 < n_bc:
+                b1 = int(np.searchsorted(indptr, indptr[b0] + chunk_size, side="right")) - 1
+                b1 = min(max(b1, b0 + 1), n_bc)
+                cs = np.concatenate([[0], np.cumsum(data[indptr[b0]:indptr[b1]], dtype=np.float64)])
+                totals[b0:b1] = cs[indptr[b0 + 1:b1 + 1] - indptr[b0]] - cs[indptr[b0:b1] - indptr[b0]]
+                b0 = b1
+        return totals
+
+    # MatrixMarket (genes x barcodes): skip the comment lines and the size line, then parse entries in chunks
+    opener = gzip.open if path.endswith(".gz") else open
+    n_header = 0
+    with opener(path, "rt") as f:
+        for line in f:
+            n_header += 1
+            if not line.startswith("%"):
+                n_rows, n_bc, nnz = (int(v) for v in line.split()[:3])
+                break
+
+    totals = np.zeros(n_bc, dtype=np.float64)
+    reader = pd.read_csv(
+        path, sep=r"\s+", skiprows=n_header, header=None, usecols=[1, 2],
+        dtype={1: np.int64, 2: np.float64}, chunksize=chunk_size, engine="c"
+    )
+    for chunk in reader:
+        totals += np.bincount(chunk[1].values - 1, weights=chunk[2].values, minlength=n_bc)
+    return totals
+
+
+# Function to compute a log-binned barcode rank curve, with knee and inflection estimates
+@profiled
+def barcode_rank_curve(
+    totals: np.ndarray,
+    n_points: int = 2000,
+    lower: float = 100
+) -> dict:
+    """
+    Compute a barcode rank curve (UMI totals sorted in decreasing order) downsampled to log-spaced ranks, and
+    estimate its knee and inflection points.
+
+    Args:
+        totals (np.ndarray): UMI totals per barcode.
+        n_points (int, optional): Maximum number of log-spaced ranks kept on the curve. Default is 2000.
+        lower (float, optional): Barcodes with fewer UMIs are ignored when estimating the knee/inflection. Default is 100.
+
+    Returns:
+        dict: 'ranks' and 'umis' of the downsampled curve, 'knee_rank'/'knee_umis' (point of maximum distance from
+        the chord of the log-log curve), 'inflection_rank'/'inflection_umis' (steepest log-log slope),
+        'n_barcodes' (barcodes with >0 UMIs) and 'total_umis'.
+    """
+    totals = np.asarray(totals, dtype=np.float64).ravel()
+    nz = totals[totals > 0]
+    umis_sorted = np.sort(nz)[::-1]
+
+    qc = {
+        "n_barcodes": len(nz),
+        "total_umis": float(nz.sum()),
+        "ranks": np.array([], dtype=np.int64),
+        "umis": np.array([]),
+        "knee_rank": np.nan, "knee_umis": np.nan,
+        "inflection_rank": np.nan, "inflection_umis": np.nan
+    }
+    if len(nz) == 0:
+        return qc
+
+    ranks = np.unique(np.geomspace(1, len(umis_sorted), num=min(n_points, len(umis_sorted))).astype(np.int64))
+    umis = umis_sorted[ranks - 1]
+    qc["ranks"], qc["umis"] = ranks, umis
+
+    # Barcodes above `lower`, plus the first point below it so that a sharp drop-off is captured
+    keep = umis >= lower
+    keep[min(keep.sum(), len(keep) - 1)] = True
+    if keep.sum() >= 3:
+        x = np.log10(ranks[keep])
+        y = np.log10(umis[keep])
+
+        # Knee: point furthest below the chord between the curve's end points
+        chord = (y[-1] - y[0]) / (x[-1] - x[0]) if x[-1] > x[0] else 0
+        dist = (y[0] + chord * (x - x[0])) - y
+        k = int(np.argmax(np.abs(dist)))
+        qc["knee_rank"], qc["knee_umis"] = int(ranks[keep][k]), float(umis[keep][k])
+
+        # Inflection: steepest descent of the log-log curve
+        slope = np.gradient(y, x)
+        j = int(np.argmin(slope))
+        qc["inflection_rank"], qc["inflection_umis"] = int(ranks[keep][j]), float(umis[keep][j])
+
+    return qc
+
+
+# Function to run barcode rank QC directly on a raw matrix file
+@profiled
+def barcode_rank_qc(
+    path: str,
+    chunk_size: int = 10_000_000,
+    n_points: int = 2000,
+    lower: float = 100,
+    verbose: bool = True
+) -> dict:
+    """
+    Stream per-barcode UMI totals from a raw count matrix (matrix.mtx[.gz], a directory holding one, or a 10x .h5
+    file) in chunks, and compute the barcode rank curve with knee/inflection estimates (see `barcode_rank_curve`).
+
+    Args:
+        path (str): Path to the raw matrix (e.g. 'Solo.out/GeneFull/raw').
+        chunk_size (int, optional): Number of matrix entries parsed at a time. Default is 10,000,000.
+        n_points (int, optional): Maximum number of log-spaced ranks kept on the curve. Default is 2000.
+        lower (float, optional): Barcodes with fewer UMIs are ignored when estimating the knee/inflection. Default is 100.
+        verbose (bool, optional): Whether to print a summary. Default is True.
+
+    Returns:
+        dict: see `barcode_rank_curve`.
+    """
+    totals = _stream_barcode_totals(path, chunk_size=chunk_size)
+    qc = barcode_rank_curve(totals, n_points=n_points, lower=lower)
+
+    if verbose:
+        print(f"{path}: {qc['n_barcodes']} barcodes, knee at rank {qc['knee_rank']} ({qc['knee_umis']} UMIs), inflection at rank {qc['inflection_rank']} ({qc['inflection_umis']} UMIs)")
+
+    return qc
+
+
+# Function to run barcode rank QC over every sample in a metadata table, in parallel
+@profiled
+def barcode_rank_qc_samples(
+    meta: pd.DataFrame,
+    sample_col: str = "sample",
+    dir_col: str = "data.dir",
+    raw_subdir: str = "Solo.out/GeneFull/raw",
+    n_jobs: int = None,
+    **kwargs
+):
+    """
+    Run `barcode_rank_qc` on the raw matrix of every included sample in a metadata table (e.g. resources/metadata.csv)
+    using a process pool.
+
+    Args:
+        meta (pd.DataFrame): One row per sample. If it has an 'include' column, only rows where it is True are used.
+        sample_col (str, optional): Column holding the sample names. Default is "sample".
+        dir_col (str, optional): Column holding each sample's STARsolo output directory. Default is "data.dir".
+        raw_subdir (str, optional): Sub-directory (relative to `dir_col`) of the raw matrix. Default is "Solo.out/GeneFull/raw".
+        n_jobs (int, optional): Number of worker processes. Default is one per sample (up to the number of cores).
+        **kwargs: Passed on to `barcode_rank_qc`.
+
+    Returns:
+        summary (pd.DataFrame): One row per sample with barcode counts and knee/inflection estimates.
+        curves (dict): Sample name -> full result of `barcode_rank_qc` (including the downsampled rank curve).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+
+    if "include" in meta.columns:
+        meta = meta.loc[meta["include"].astype(str).str.upper() == "TRUE"]
+    meta = meta.reset_index(drop=True)
+
+    if n_jobs is None:
+        n_jobs = min(len(meta), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        futures = {
+            meta[sample_col][i]: pool.submit(worker_call, barcode_rank_qc, os.path.join(meta[dir_col][i], raw_subdir), **kwargs)
+            for i in range(meta.shape[0])
+        }
+        curves = {sample: collect_worker_records(f.result()) for sample, f in futures.items()}
+
+    summary = pd.DataFrame({
+        sample: {k: v for k, v in qc.items() if k not in ["ranks", "umis"]}
+        for sample, qc in curves.items()
+    }).T
+    summary.index.name = sample_col
+
+    return summary, curves
+
+
+# Default per-sample QC thresholds, used when a metadata column is missing or NA
+QC_DEFAULTS = {
+    "min_genes": 500,
+    "min_counts": 1500,
+    "min_cells": 5,
+    "max_pct_mito": 20,
+    "doublet_cutoff": 0.2
+}
+
+
+# QC + doublet detection for a single sample; module-level so it can be sent to worker processes
+def _qc_sample(
+    adata: ad.AnnData,
+    params: dict,
+    mito_prefix: str,
+    run_scrublet: bool,
+    random_state: int
+):
+    summary = {"n_cells_raw": adata.n_obs, "n_genes_raw": adata.n_vars}
+
+    # Hard filters for feature and UMI counts
+    sc.pp.filter_cells(adata, min_genes=params["min_genes"])
+    sc.pp.filter_cells(adata, min_counts=params["min_counts"])
+
+    # Hard filter for sparsely detected features
+    sc.pp.filter_genes(adata, min_cells=params["min_cells"])
+
+    adata.var['mito'] = adata.var_names.str.startswith(mito_prefix)
+    sc.pp.calculate_qc_metrics(
+        adata, 
+        qc_vars=['mito'], 
+        percent_top=None, 
+        log1p=False, 
+        inplace=True
+    )
+    adata = adata[adata.obs.pct_counts_mito < params["max_pct_mito"], :].copy()
+    summary["n_cells_qc"] = adata.n_obs
+
+    if run_scrublet:
+        if hasattr(sc.pp, "scrublet"):
+            sc.pp.scrublet(adata, threshold=params["doublet_cutoff"], random_state=random_state)
+        else:
+            import scanpy.external as sce
+            sce.pp.scrublet(adata, threshold=params["doublet_cutoff"], random_state=random_state)
+        summary["median_doublet_score"] = float(np.median(adata.obs["doublet_score"]))
+
+        ## Remove doublets
+        adata = adata[adata.obs["doublet_score"] < params["doublet_cutoff"], :].copy()
+
+    summary["n_cells_final"] = adata.n_obs
+    summary["n_genes_final"] = adata.n_vars
+    summary["median_counts"] = float(np.median(adata.obs["total_counts"])) if adata.n_obs > 0 else np.nan
+    summary["median_pct_mito"] = float(np.median(adata.obs["pct_counts_mito"])) if adata.n_obs > 0 else np.nan
+
+    return adata, summary
+
+
+# Function to run per-sample QC and doublet removal in parallel, with thresholds read from the metadata table
+@profiled
+def qc_samples(
+    adata_list: list,
+    meta: pd.DataFrame,
+    sample_col: str = "sample",
+    mito_prefix: str = "MT-",
+    run_scrublet: bool = True,
+    random_state: int = 0,
+    n_jobs: int = None,
+    verbose: bool = True
+):
+    """
+    Filter cells/genes, remove high-mito cells and (optionally) score and remove doublets with scrublet, for every
+    sample in parallel. Thresholds are read per sample from the metadata table (see resources/metadata.csv):
+
+        min_genes, min_counts  -- minimum genes / UMIs per cell
+        min_cells              -- minimum number of cells a gene must be detected in
+        max_pct_mito           -- cells with this % of mitochondrial counts or more are removed
+        doublet_cutoff         -- cells with a scrublet doublet score at or above this value are removed
+
+    Missing columns or NA values fall back to QC_DEFAULTS.
+
+    Args:
+        adata_list (list): AnnData objects, e.g. from `load_samples`. Samples are matched to rows of `meta` by
+            adata.obs[sample_col] when present, otherwise by position among the included rows.
+        meta (pd.DataFrame): Metadata table, one row per sample. If it has an 'include' column, only rows where it is True are used.
+        sample_col (str, optional): Column holding the sample names. Default is "sample".
+        mito_prefix (str, optional): Prefix of mitochondrial gene names. Default is "MT-".
+        run_scrublet (bool, optional): Whether to run scrublet and remove doublets. Default is True.
+        random_state (int, optional): Seed passed to scrublet. Default is 0.
+        n_jobs (int, optional): Number of worker processes. Default is one per sample (up to the number of cores).
+        verbose (bool, optional): Whether to print the summary table. Default is True.
+
+    Returns:
+        adata_list (list): Filtered AnnData objects, in the same order as the input.
+        summary (pd.DataFrame): One row per sample with the thresholds used and cell/gene counts after each step.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+
+    if "include" in meta.columns:
+        meta = meta.loc[meta["include"].astype(str).str.upper() == "TRUE"]
+    meta = meta.reset_index(drop=True)
+
+    # Per-sample thresholds
+    params_list = []
+    names = []
+    for i, adata in enumerate(adata_list):
+        if sample_col in adata.obs.columns:
+            name = str(adata.obs[sample_col].iloc[0])
+            row = meta.loc[meta[sample_col].astype(str) == name]
+            if row.shape[0] == 0:
+                raise ValueError(f"Sample '{name}' not found in metadata")
+            row = row.iloc[0]
+        else:
+            row = meta.iloc[i]
+            name = str(row[sample_col])
+
+        params = {}
+        for key, default in QC_DEFAULTS.items():
+            value = pd.to_numeric(row.get(key, np.nan), errors="coerce")
+            params[key] = default if pd.isna(value) else value
+        for key in ["min_genes", "min_counts", "min_cells"]:
+            params[key] = int(params[key])
+        params_list.append(params)
+        names.append(name)
+
+    if n_jobs is None:
+        n_jobs = min(len(adata_list), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        futures = [
+            pool.submit(worker_call, _qc_sample, adata, params, mito_prefix, run_scrublet, random_state)
+            for adata, params in zip(adata_list, params_list)
+        ]
+        results = [collect_worker_records(f.result()) for f in futures]
+
+    adata_list = [res[0] for res in results]
+    summary = pd.DataFrame(
+        [{**params, **res[1]} for params, res in zip(params_list, results)],
+        index=pd.Index(names, name=sample_col)
+    )
+
+    if verbose:
+        print("Final cell & feature counts:\n")
+        print(summary[["n_cells_raw", "n_cells_qc", "n_cells_final", "n_genes_final"]].to_string())
+
+    return adata_list, summary